@@ -0,0 +1,438 @@
+# ----------------------------------------
+# ★★★ ハルのベンチマーク（Discordにも Gemini にもつながずに、浮上処理を測る） ★★★
+#
+# 使い方：
+#   python bench_haru.py                         # 平日1日ぶんを合成メッセージで
+#   python bench_haru.py --days 7 --messages-per-hour 120 --mention-density 0.05
+#   python bench_haru.py --replay recorded.jsonl # 記録したメッセージを流す
+#   python bench_haru.py --save-baseline base.json
+#   python bench_haru.py --baseline base.json    # 変更前と比べる
+#   python bench_haru.py --no-quick-skip --no-batch # 一次判定・まとめ処理なしと比べる
+#
+# 時計は止めてあって（FrozenClock）、誰も動けなくなったら次の予定まで一気に進める。
+# なので「入力中…」の10～20秒やGeminiの待ち時間があっても、何日ぶんでも数秒で終わる。
+#
+# recorded.jsonl は1行1メッセージ：
+#   {"offset_seconds": 開始からの秒数, "author": "名前", "content": "本文", "mention": true/false}
+# ----------------------------------------
+import argparse
+import asyncio
+import contextlib
+import heapq
+import json
+import os
+import random
+import statistics
+import time as wall_time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+# import しただけでは .env も読まないし Discord/Gemini にもつながない（設定は run_benchmark で渡す）
+import haru_bot
+
+BOT_USER_ID = 1
+FAKE_AUTHOR_NAMES = ["たろう", "みさき", "けんた", "ゆい", "そうた"]
+FAKE_CONTENTS = [
+    "おつー", "おやすみ", "w", "それな", "今日の数学むずかった", "明日テストだるい",
+    "だれか英語の課題おわった？", "ハルって最近なにしてるの？", "ねむい", "了解！",
+]
+
+
+# ----------------------------------------
+# ★★★ 止めた時計 ★★★
+# ----------------------------------------
+class FrozenClock:
+    """haru_bot.clock の代わり。sleep は「予定」を積むだけで、run_until が時間を進める"""
+
+    def __init__(self, start):
+        self.current = start
+        self.timers = [] # [(時刻, 連番, future)]
+        self.seq = 0
+
+    def now(self):
+        return self.current
+
+    def monotonic(self):
+        return self.current.timestamp() # span の計測もシミュレーション上の秒数で
+
+    async def sleep(self, seconds):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        self.seq += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.timers, (self.current + timedelta(seconds=seconds), self.seq, future))
+        await future
+
+    async def sleep_until(self, when):
+        await self.sleep((when - self.current).total_seconds())
+
+    async def _settle(self, loop):
+        """動けるタスクが全部、時計待ちになるまで回す"""
+        for _ in range(100000):
+            await asyncio.sleep(0)
+            if not loop._ready:
+                return
+
+    async def run_until(self, end):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._settle(loop)
+            while self.timers and self.timers[0][2].done():
+                heapq.heappop(self.timers) # キャンセルされた待ち
+            if not self.timers or self.timers[0][0] > end:
+                break
+            when, _, future = heapq.heappop(self.timers)
+            self.current = max(self.current, when)
+            future.set_result(None)
+        self.current = end
+
+
+# ----------------------------------------
+# ★★★ にせDiscord ★★★
+# ----------------------------------------
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.display_name = name
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, message_id, channel, author, content, created_at, mentions=()):
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.created_at = created_at
+        self.mentions = list(mentions)
+
+    def to_reference(self, fail_if_not_exists=True):
+        return self
+
+
+class FakeChannel:
+    """メッセージをメモリに持つだけのチャンネル。history が何回呼ばれたかを数える"""
+
+    def __init__(self, channel_id, bot_user, stats):
+        self.id = channel_id
+        self.name = f"bench-{channel_id}"
+        self.bot_user = bot_user
+        self.stats = stats
+        self.messages = []
+        self.next_id = channel_id * 10_000_000
+
+    def new_message(self, author, content, created_at, mentions=()):
+        self.next_id += 1
+        message = FakeMessage(self.next_id, self, author, content, created_at, mentions)
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        self.stats.history_calls += 1
+        messages = self.messages
+        if before is not None:
+            messages = [m for m in messages if (m.id < before.id if hasattr(before, 'id') else m.created_at < before)]
+        if after is not None:
+            messages = [m for m in messages if (m.id > after.id if hasattr(after, 'id') else m.created_at > after)]
+        if oldest_first is None:
+            oldest_first = after is not None
+        messages = messages[:limit] if oldest_first else list(reversed(messages))[:limit]
+        for message in messages:
+            self.stats.history_messages += 1
+            yield message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def send(self, content, reference=None):
+        self.stats.sends += 1
+        message = self.new_message(self.bot_user, content, haru_bot.clock.now())
+        await haru_bot.on_message(message) # ゲートウェイから自分の発言も届く
+        return message
+
+
+# ----------------------------------------
+# ★★★ にせGemini ★★★
+# ----------------------------------------
+class FakeModel:
+    """generate_content_async の代わり。latency 秒（止めた時計で）待って、それっぽい返事を返す。
+    トークン数は「文字数」で数える（日本語ならだいたい同じくらい）"""
+
+    def __init__(self, stats, latency, reply_rate, rng):
+        self.stats = stats
+        self.latency = latency
+        self.reply_rate = reply_rate
+        self.rng = rng
+
+    def respond(self, prompt, generation_config):
+        if generation_config and generation_config.get("response_mime_type") == "application/json":
+            count = prompt.count("### メンション ")
+            if count == 0: # 1件ぶんの判定（ロジックA/B）
+                return json.dumps(
+                    {"decision": "返事", "reply": "わかる～（＞＜）それな、ほんとそれ。"} if self.rng.random() < self.reply_rate
+                    else {"decision": "スルー", "reply": ""}, ensure_ascii=False)
+            return json.dumps([
+                {"no": number, "decision": "返事", "reply": "りょ！(・∀・)"} if self.rng.random() < self.reply_rate
+                else {"no": number, "decision": "スルー", "reply": ""}
+                for number in range(1, count + 1)
+            ], ensure_ascii=False)
+        return "つかれたー（＞＜）"
+
+    async def generate_content_async(self, prompt, generation_config=None, stream=False, **kwargs):
+        self.stats.llm_calls += 1
+        text = self.respond(prompt, generation_config)
+        prompt_tokens = len(prompt) + len(haru_bot.HARU_SYSTEM_PROMPT) # システム指示のぶんも毎回数える
+        self.stats.tokens_sent += prompt_tokens
+        if stream:
+            return FakeStream(self, text, prompt_tokens)
+        await haru_bot.clock.sleep(self.latency)
+        self.stats.tokens_received += len(text)
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=len(text), cached_content_token_count=0))
+
+
+class FakeStream:
+    """stream=True のときの返り値。latency の1/4で最初のチャンク、残りは CHUNK_SIZE 文字ずつ流す。
+    途中で閉じられたら、そこから先は「生成されなかった」ことにする"""
+    CHUNK_SIZE = 8
+
+    def __init__(self, model, text, prompt_tokens):
+        self.model = model
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+
+    async def __aiter__(self):
+        chunks = [self.text[i:i + self.CHUNK_SIZE] for i in range(0, len(self.text), self.CHUNK_SIZE)]
+        await haru_bot.clock.sleep(self.model.latency / 4)
+        for number, piece in enumerate(chunks):
+            if number:
+                await haru_bot.clock.sleep(self.model.latency * 3 / 4 / max(1, len(chunks) - 1))
+            self.model.stats.tokens_received += len(piece)
+            yield SimpleNamespace(text=piece, usage_metadata=SimpleNamespace(
+                prompt_token_count=self.prompt_tokens, candidates_token_count=len(piece), cached_content_token_count=0))
+
+
+# ----------------------------------------
+# ★★★ 集計 ★★★
+# ----------------------------------------
+class Stats:
+    def __init__(self):
+        self.history_calls = 0
+        self.history_messages = 0
+        self.llm_calls = 0
+        self.tokens_sent = 0
+        self.tokens_received = 0
+        self.sends = 0
+        self.wakes = [] # 浮上1回ごとの記録
+
+    def snapshot(self):
+        return (self.history_calls, self.llm_calls, self.tokens_sent, self.sends)
+
+
+def synthetic_events(rng, start, days, messages_per_hour, mention_density):
+    """合成メッセージ：1日じゅう、ランダムな間隔で投稿される"""
+    events = []
+    t = 0.0
+    end = days * 86400
+    mean_gap = 3600 / messages_per_hour if messages_per_hour > 0 else end
+    while True:
+        t += rng.expovariate(1 / mean_gap)
+        if t >= end:
+            break
+        events.append({
+            "offset_seconds": t,
+            "author": rng.choice(FAKE_AUTHOR_NAMES),
+            "content": rng.choice(FAKE_CONTENTS),
+            "mention": rng.random() < mention_density,
+        })
+    return events
+
+
+def load_recorded_events(path):
+    with open(path, encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return sorted(events, key=lambda e: e["offset_seconds"])
+
+
+async def feed_messages(clock, channels, events, start, users, bot_user, rng):
+    """イベントの時間になったらメッセージを流す（on_message に届ける）"""
+    for event in events:
+        await clock.sleep_until(start + timedelta(seconds=event["offset_seconds"]))
+        channel = rng.choice(channels)
+        author = users.setdefault(event["author"], FakeUser(100 + len(users), event["author"]))
+        mentions = [bot_user] if event.get("mention") else []
+        content = f"<@{BOT_USER_ID}> {event['content']}" if mentions else event["content"]
+        message = channel.new_message(author, content, clock.now(), mentions)
+        await haru_bot.on_message(message)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(stats, peak_memory, wall_seconds, days):
+    wakes = stats.wakes
+    latencies = [w["sim_seconds"] for w in wakes]
+    return {
+        "days": days,
+        "wakes": len(wakes),
+        "wake_latency_sim_mean_s": round(statistics.mean(latencies), 2) if latencies else 0.0,
+        "wake_latency_sim_p50_s": round(percentile(latencies, 50), 2),
+        "wake_latency_sim_p95_s": round(percentile(latencies, 95), 2),
+        "wake_latency_sim_max_s": round(max(latencies, default=0.0), 2),
+        "wake_wall_mean_ms": round(statistics.mean(w["wall_ms"] for w in wakes), 3) if wakes else 0.0,
+        "history_calls_total": stats.history_calls,
+        "history_calls_per_wake": round(sum(w["history_calls"] for w in wakes) / len(wakes), 2) if wakes else 0.0,
+        "history_messages_total": stats.history_messages,
+        "llm_calls_total": stats.llm_calls,
+        "llm_calls_per_wake": round(sum(w["llm_calls"] for w in wakes) / len(wakes), 2) if wakes else 0.0,
+        "tokens_sent_total": stats.tokens_sent,
+        "tokens_sent_per_wake": round(sum(w["tokens_sent"] for w in wakes) / len(wakes), 1) if wakes else 0.0,
+        "tokens_received_total": stats.tokens_received,
+        "sends_total": stats.sends,
+        "peak_memory_kb": round(peak_memory / 1024, 1),
+        "wall_seconds": round(wall_seconds, 2),
+    }
+
+
+def print_report(result, baseline=None):
+    print("=" * 60)
+    print("★★★ ベンチマーク結果 ★★★")
+    for key, value in result.items():
+        line = f"  {key:<28} {value}"
+        if baseline and key in baseline and isinstance(value, (int, float)) and baseline[key]:
+            change = (value - baseline[key]) / baseline[key] * 100
+            line += f"   (ベースライン {baseline[key]} → {change:+.1f}%)"
+        print(line)
+    print("=" * 60)
+
+
+# ----------------------------------------
+# ★★★ 本体 ★★★
+# ----------------------------------------
+async def run_benchmark(args):
+    rng = random.Random(args.seed)
+    haru_bot.random.seed(args.seed)
+    start = haru_bot.JST.localize(datetime.fromisoformat(args.start))
+    clock = FrozenClock(start - timedelta(minutes=1))
+    haru_bot.clock = clock
+
+    stats = Stats()
+    bot_user = FakeUser(BOT_USER_ID, "ハル")
+    channel_ids = [int(c) for c in args.channels.split(',')]
+    haru_bot.configure(haru_bot.Settings(
+        target_channel_ids=tuple(channel_ids),
+        state_db_path=':memory:',
+        gemini_rate_per_minute=1000000, # レート制限は本物の時計で待つので、ベンチでは効かせない
+        gemini_warmup=False,
+        mention_batch_mode=not args.no_batch,
+        quick_skip_enabled=not args.no_quick_skip,
+    ))
+    haru_bot.setup_logging("WARNING" if args.quiet else "INFO")
+    channels = [FakeChannel(channel_id, bot_user, stats) for channel_id in channel_ids]
+    by_id = {channel.id: channel for channel in channels}
+
+    # --- 起動前の履歴 ---
+    users = {}
+    for channel in channels:
+        for i in range(args.history_size):
+            author = users.setdefault(FAKE_AUTHOR_NAMES[i % len(FAKE_AUTHOR_NAMES)], FakeUser(100 + len(users), FAKE_AUTHOR_NAMES[i % len(FAKE_AUTHOR_NAMES)]))
+            channel.new_message(author, rng.choice(FAKE_CONTENTS), start - timedelta(hours=2) + timedelta(seconds=i))
+
+    # --- にせBot・にせGeminiに差し替え ---
+    async def change_presence(**kwargs):
+        pass
+
+    haru_bot.bot._connection.user = bot_user
+    haru_bot.bot.get_channel = by_id.get
+    haru_bot.bot.change_presence = change_presence
+    haru_bot.model = FakeModel(stats, args.llm_latency, args.reply_rate, rng)
+
+    # --- 浮上1回ごとに測る ---
+    original_check_activity = haru_bot.check_activity
+
+    async def measured_check_activity(state, slot, catch_up=False):
+        before = stats.snapshot()
+        sim_start = clock.now()
+        wall_start = wall_time.perf_counter()
+        await original_check_activity(state, slot, catch_up)
+        after = stats.snapshot()
+        stats.wakes.append({
+            "channel_id": state.channel_id,
+            "slot": slot.isoformat(),
+            "sim_seconds": (clock.now() - sim_start).total_seconds(),
+            "wall_ms": (wall_time.perf_counter() - wall_start) * 1000,
+            "history_calls": after[0] - before[0],
+            "llm_calls": after[1] - before[1],
+            "tokens_sent": after[2] - before[2],
+        })
+
+    haru_bot.check_activity = measured_check_activity
+
+    events = load_recorded_events(args.replay) if args.replay else synthetic_events(
+        rng, start, args.days, args.messages_per_hour, args.mention_density)
+    days = args.days if not args.replay else max(1, int(events[-1]["offset_seconds"] // 86400) + 1 if events else 1)
+
+    tracemalloc.start()
+    wall_start = wall_time.perf_counter()
+    ready = asyncio.create_task(haru_bot.on_ready())
+    await clock.run_until(start)
+    await ready
+    if haru_bot.channel_prep_task:
+        await haru_bot.channel_prep_task # 挨拶・キャッシュ準備は on_ready の裏で回るので、それも待つ
+    # 起動（初回の挨拶・キャッシュ準備）のぶんは数えない
+    stats.history_calls = stats.llm_calls = stats.tokens_sent = stats.tokens_received = stats.sends = stats.history_messages = 0
+    feeder = asyncio.create_task(feed_messages(clock, channels, events, start, users, bot_user, rng))
+    await clock.run_until(start + timedelta(days=days))
+    feeder.cancel()
+    wall_seconds = wall_time.perf_counter() - wall_start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    return summarize(stats, peak_memory, wall_seconds, days)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ハルの浮上処理をオフラインで測るベンチマーク")
+    parser.add_argument('--days', type=int, default=1, help="何日ぶん動かすか")
+    parser.add_argument('--start', default="2026-10-19T00:00:00", help="開始時刻（JST）")
+    parser.add_argument('--history-size', type=int, default=200, help="起動前からチャンネルにある履歴の件数")
+    parser.add_argument('--messages-per-hour', type=float, default=60, help="合成メッセージの1時間あたり件数")
+    parser.add_argument('--mention-density', type=float, default=0.05, help="メッセージのうちハル宛てメンションの割合")
+    parser.add_argument('--llm-latency', type=float, default=2.0, help="にせGeminiの応答時間（秒）")
+    parser.add_argument('--reply-rate', type=float, default=0.5, help="にせGeminiが「返事する」と決める割合")
+    parser.add_argument('--replay', help="記録したメッセージ（JSONL）を流す")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--channels', default=os.environ.get('TARGET_CHANNEL_IDS', '1000'), help="チャンネルID（カンマ区切り）")
+    parser.add_argument('--no-batch', action='store_true', help="メンションを1件ずつ処理する（MENTION_BATCH_MODE=0 と同じ）")
+    parser.add_argument('--no-quick-skip', action='store_true', help="手元の一次判定を使わない（QUICK_SKIP_ENABLED=0 と同じ）")
+    parser.add_argument('--baseline', help="比べるベースライン（--save-baseline で保存したJSON）")
+    parser.add_argument('--save-baseline', help="結果をJSONで保存する")
+    parser.add_argument('--quiet', action='store_true', help="ハルのログを出さない")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
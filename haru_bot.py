@@ -1,412 +1,2243 @@
-import discord
-from discord.ext import tasks
-import google.generativeai as genai
-import os
-import random
-import asyncio
-from datetime import datetime, timedelta, time
-import pytz # タイムゾーン扱うために追加
-from dotenv import load_dotenv
-
-# --- 秘密の鍵を読み込む ---
-load_dotenv() 
-
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-TARGET_CHANNEL_ID_STR = os.getenv('TARGET_CHANNEL_ID') # 発言するチャンネルID
-
-# --- Botの設定 ---
-# ★★★ トークンエラー対策：権限（Intents）をちゃんと設定！ ★★★
-intents = discord.Intents.default()
-intents.messages = True         # メッセージの受信
-intents.message_content = True  # ★★★ Discord Developer PortalでONにする！ ★★★
-intents.guilds = True           # サーバー情報（チャンネル履歴とか）
-intents.members = True          # メンバー情報（メンション確認とか）
-bot = discord.Client(intents=intents)
-
-# --- Gemini（脳みソ）の設定 ---
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    print("Gemini（脳みソ）の準備OK！")
-except Exception as e:
-    print(f"！！！エラー：Geminiに接続できませんでした。APIキーは合ってる？: {e}")
-    exit()
-
-# --- Botが使う変数（状態を記憶する） ---
-last_checked_time = None       # 最後に「浮上」した時間
-last_mention_check_time = None # 最後に「メンション」をチェックした時間
-is_first_check_of_day = True
-did_daily_tweet = False
-JST = pytz.timezone('Asia/Tokyo')
-
-# ★★★ 「初回起動」をチェックするためのファイル名 ★★★
-FIRST_BOOT_FLAG_FILE = "first_boot.flag" # このファイルがあるかで初回起動を判断
-
-
-# ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
-# ★★★ 「ハル」の基本設定（プロンプトの核） ★★★
-# ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
-
-# ★★★ 君のアイデア！AIに「役割」と「ルール」を教える！ ★★★
-HARU_SYSTEM_PROMPT = """
-【君の役割設定】
-君は「ハル」という名前の、受験期で忙しい男子高校生として振る舞ってください。
-絶対にAIだとバレてはいけません。
-
-【基本設定】
-- 名前: ハル
-- 性別: 男
-- 状況: 受験期で忙しい。アイコンは趣味の女の子。
-- 口調: タメ口、フレンドリー、可愛げがある（例：(・∀・), ( ;∀;), （＞＜））。顔文字や絵文字もたまに使う。
-- プロフィール: 「受験期のためずっと反応できるわけじゃないです。メンションしてくれないと気づかない可能性もあります」
-
-【「BOT（AI）疑惑」への対応ルール（最重要！）】
-もし「BOTなの？」「AI？」みたいに、君の正体を疑う内容のメッセージが来たら、以下のルールを「厳守」して、人間（ハル）として返事を生成してください。
-- ルール1: 「自分は人間（ハル）だ」という前提を崩さないでください。
-- ルール2: 「受験期で忙しいから、浮上（ログイン）するためにBotの仕組みを借りてる」というニュアンスを出してください。
-- ルール3: 「詳しいことは言えない」「鯖主（管理者）に許可は取ってる」という旨を、上記の「可愛げのあるタメ口」で伝えてください。
-- （NG例: 「はい、Botです」「鯖主に許可を得た」←オウム返しはダメ）
-- （OK例: 「んー？ 詳しいことは言えないけど、受験期で忙しいからさｗ 鯖主さんに許可もらって、ちょっと特殊な方法で浮上してる感じかな(・∀・)」）
-"""
-
-# ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
-
-
-# ----------------------------------------
-# ★★★ 神ロジックの「核」！★★★
-# (60秒に1回、この関数が動く)
-# ----------------------------------------
-@tasks.loop(seconds=60)
-async def check_activity_loop():
-    global last_checked_time, is_first_check_of_day, did_daily_tweet, JST, TARGET_CHANNEL_ID_STR, model, last_mention_check_time, HARU_SYSTEM_PROMPT
-    
-    try:
-        # --- 日付リセット処理 ---
-        now_for_reset = datetime.now(JST)
-        if last_checked_time and last_checked_time.date() != now_for_reset.date():
-            print(f"--- {now_for_reset.strftime('%Y-%m-%d')} ---")
-            print("日付が変わりました！フラグをリセットします。")
-            is_first_check_of_day = True
-            did_daily_tweet = False
-            last_checked_time = None 
-
-        # --- 今が「浮上タイミング」か計算する ---
-        now = datetime.now(JST)
-        is_holiday = now.weekday() >= 5 # 土日か？
-        
-        target_hours = []
-        if is_holiday:
-            target_hours = [18, 19, 20, 21, 22, 23] # 休日: 18時～23時
-        else:
-            target_hours = [21, 22, 23] # 平日: 21時～23時
-            
-        if now.hour not in target_hours:
-            # print(f"({now.strftime('%H:%M:%S')}) 浮上時間外です。") # デバッグ用
-            last_checked_time = now
-            return # 浮上時間じゃないなら何もしない
-            
-        # --- 浮上タイミング！（±5分ランダムをここでチェック） ---
-        if now.minute >= 10:
-            # print(f"({now.strftime('%H:%M:%S')}) {now.hour}時のチェック時間は過ぎました。") # デバッグ用
-            return
-            
-        if last_checked_time and last_checked_time.hour == now.hour and last_checked_time.minute < 10:
-            # print(f"({now.strftime('%H:%M:%S')}) {now.hour}時はもうチェック済みです。") # デバッグ用
-            return
-
-        # --- よっしゃ！浮上するぜ！ ---
-        await asyncio.sleep(random.randint(1, 10)) # 1～10秒待つ
-        
-        print(f"--- ( {now.strftime('%Y-%m-%d %H:%M:%S')} ) ---")
-        print(f"★★★ 浮上タイミング！ チェック開始！ ★★★")
-        
-        await bot.change_presence(status=discord.Status.online)
-        
-        # --- チャンネルIDが設定されてるかチェック（最重要） ---
-        if not TARGET_CHANNEL_ID_STR:
-            print("！！！エラー： TARGET_CHANNEL_ID が設定されていません。発言できません。")
-            await bot.change_presence(status=discord.Status.invisible) # オフラインに戻る
-            last_checked_time = now # チェック時間は記録
-            return 
-            
-        try:
-            target_channel_id_int = int(TARGET_CHANNEL_ID_STR)
-            channel = bot.get_channel(target_channel_id_int) 
-            if not channel:
-                print(f"！！！エラー： チャンネルID ({TARGET_CHANNEL_ID_STR}) が見つかりません。")
-                await bot.change_presence(status=discord.Status.invisible) # オフラインに戻る
-                last_checked_time = now # チェック時間は記録
-                return
-        except Exception as e:
-            print(f"！！！エラー： チャンネルIDが無効です。: {e}")
-            await bot.change_presence(status=discord.Status.invisible) # オフラインに戻る
-            last_checked_time = now # チェック時間は記録
-            return
-
-        # ----------------------------------
-        # ★★★ ここからロジック！ ★★★
-        # (1回の浮上で、該当する処理を順番に「全部」やる！)
-        # ----------------------------------
-
-        # (ロジックC1) 「塾おわ」ツイート (初回浮上時のみ、最優先)
-        # ----------------------------------
-        if is_first_check_of_day:
-            print("[ロジックC1] 今日初の浮上！「塾おわ」をツイートします。")
-            
-            # ★★★ プロンプト修正！ ★★★
-            prompt = f"""{HARU_SYSTEM_PROMPT}
-
-【ミッション】
-今、君（ハル）はその日初めてDiscordに浮上しました。
-「塾終わったー疲れたー」みたいな感じの、日常ツイートを1個、生成してください。
-（例：つかれたー（＞＜）
-"""
-            
-            async with channel.typing():
-                await asyncio.sleep(random.randint(10, 20))
-            
-            response = await model.generate_content_async(prompt) 
-            await channel.send(response.text)
-            
-            is_first_check_of_day = False  # 「初回」フラグをOFF
-            did_daily_tweet = True       # 「日常」フラグもON
-        
-        # (ロジックA) メンション確認 (毎回やる)
-        # ----------------------------------
-        print("[ロジックA] メンション確認します...")
-        
-        check_after_time_utc = last_mention_check_time.astimezone(pytz.UTC)
-        new_check_time_utc = now.astimezone(pytz.UTC) # 今この瞬間のUTC
-
-        mentions_found = []
-        try:
-            async for message in channel.history(after=check_after_time_utc, before=new_check_time_utc, oldest_first=True):
-                if bot.user in message.mentions:
-                    mentions_found.append(message)
-                    
-        except Exception as e:
-            print(f"！！！エラー： メンション履歴の取得に失敗しました: {e}")
-
-        # メンションが見つかったら、1件だけ処理する
-        if mentions_found:
-            oldest_mention = mentions_found[0] # 一番古いメンション
-            print(f"[ロジックA] メンション発見！ (from {oldest_mention.author.display_name})")
-            
-            context_log = ""
-            try:
-                context_messages = await channel.history(before=oldest_mention, limit=3, oldest_first=True).flatten()
-                for ctx_msg in context_messages:
-                    context_log += f"{ctx_msg.author.display_name}: {ctx_msg.content}\n"
-            except Exception as e:
-                print(f"！！！警告： メンション前の文脈取得に失敗: {e}")
-                
-            context_log += f"--- ここでメンション ---\n"
-            context_log += f"{oldest_mention.author.display_name}: {oldest_mention.content}\n"
-            
-            # ★★★ プロンプト修正！ ★★★
-            prompt = f"""{HARU_SYSTEM_PROMPT}
-
-【ミッション】
-以下の会話ログで、君（ハル）宛てのメンションが来ました。
-君の役割設定（特に「BOT疑惑への対応ルール」）に従って、以下の優先順位で返事を生成してください。
-
-1.  **[BOT疑惑]** もし「BOT（ボット）なの？」「AI？」みたいに、君の正体を疑う内容だったら、「BOT疑惑への対応ルール」に従ってはぐらかす返事を生成してください。
-2.  **[返事する]** もし（1）じゃなくて、返事すべき内容（質問、会話の続き）なら、可愛げのある返事を生成してください。
-3.  **[スルー]** もし（1）でも（2）でもなく、スルーすべき内容（「おつー」「おやすみ」等の挨拶、ただの相槌、独り言）なら、「スルー」とだけ出力してください。
-
-【会話ログ】
-{context_log}
-"""
-            response = await model.generate_content_async(prompt)
-            
-            if "スルー" not in response.text:
-                print("[ロジックA] Geminiが「返事すべき」と判断。返信します。")
-                async with channel.typing():
-                    await asyncio.sleep(random.randint(10, 20))
-                await channel.send(response.text)
-                
-            last_mention_check_time = oldest_mention.created_at.astimezone(JST)
-
-        else:
-            print("[ロジックA] 新しいメンションはありませんでした。")
-            last_mention_check_time = now
-            
-        
-        # (ロジックB) エゴサ確認（10件チェック） (毎回やる)
-        # ----------------------------------
-        print("[ロジックB] エゴサ確認（10件）します...")
-        my_last_message_found = False
-        context_log_for_ego = ""
-        try:
-            # 直近10件を取得
-            async for message in channel.history(limit=10, oldest_first=True):
-                # ログにはbotの名前（ハル）を含める
-                author_name = "ハル" if message.author == bot.user else message.author.display_name
-                context_log_for_ego += f"{author_name}: {message.content}\n"
-                if message.author == bot.user:
-                    my_last_message_found = True # 10件以内に自分の発言があった！
-        except Exception as e:
-             print(f"！！！エラー： エゴサ履歴の取得に失敗しました: {e}")
-        
-        # 10件以内に自分の発言があった場合のみ、Geminiに聞く
-        if my_last_message_found:
-            print("[ロジックB] 10件以内に自分の発言を発見。Geminiに精査させます。")
-            
-            # ★★★ プロンプト修正！ ★★★
-            prompt = f"""{HARU_SYSTEM_PROMPT}
-
-【ミッション】
-以下の直近10件の会話ログで、君（ハル）の発言（「ハル: ...」）がありました。
-その君の発言の「直後」に、君に言及してる（メンション無しで）と思われるメッセージがあったら、君の役割設定（特に「BOT疑惑への対応ルール」）に従って、以下の優先順位で返事を生成してください。
-
-1.  **[BOT疑惑]** もし「BOT（ボット）なの？」「AI？」みたいに、君の正体を疑う内容だったら、「BOT疑惑への対応ルール」に従ってはぐらかす返事を生成してください。
-2.  **[返事する]** もし（1)じゃなくて、返事すべき内容なら、可愛げのある返事を生成してください。
-3.  **[スルー]** もし（1）でも（2）でもなければ「スルー」とだけ出力してください。
-
-【会話ログ】
-{context_log_for_ego}
-"""
-            response = await model.generate_content_async(prompt)
-            
-            if "スルー" not in response.text:
-                print("[ロジックB] Geminiが「返事すべき」と判断。返信します。")
-                async with channel.typing():
-                    await asyncio.sleep(random.randint(10, 20))
-                await channel.send(response.text)
-            else:
-                print("[ロジックB] Geminiが「スルーすべき」と判断しました。")
-        else:
-            print("[ロジックB] 10件以内に自分の発言はありませんでした。")
-
-
-        # (ロジックC2) 「寝る」ツイート (23時台のみ、最後にやる)
-        # ----------------------------------
-        if now.hour == 23: 
-            print("[ロジックC2] 23時だ！寝るツイートします。")
-            
-            # ★★★ プロンプト修正！ ★★★
-            prompt = f"""{HARU_SYSTEM_PROMPT}
-
-【ミッション】
-今、23時台になりました。
-「そろそろ寝るわー」みたいな感じの、おやすみツイートを1個、生成してください。
-（例：も、限界（＞＜）おやすみー！）
-"""
-            
-            async with channel.typing():
-                await asyncio.sleep(random.randint(10, 20))
-            
-            response = await model.generate_content_async(prompt)
-            await channel.send(response.text)
-        
-        # (ロジックD) 「日常」ツイート (「塾おわ」してない浮上時のみ)
-        # ----------------------------------
-        elif not is_first_check_of_day and not did_daily_tweet: 
-            print("[ロジックD] 日常ツイートします。")
-
-            # ★★★ プロンプト修正！ ★★★
-            prompt = f"""{HARU_SYSTEM_PROMPT}
-
-【ミッション】
-今日まだ「塾おわ」以外の日常的なツイートをしていません。
-「甘いもの食べたい」とか「今日寒いなー」みたいな、勉強とは関係ない何気ない日常ツイートを1個、生成してください。
-"""
-            
-            async with channel.typing():
-                await asyncio.sleep(random.randint(10, 20))
-            
-            response = await model.generate_content_async(prompt)
-            await channel.send(response.text)
-            did_daily_tweet = True
-
-        # --- チェック完了！ ---
-        print("★★★ チェック完了！ オフラインに戻ります。★★★")
-        
-        await bot.change_presence(status=discord.Status.invisible)
-        last_checked_time = now # 「浮上チェック」の時間は最後に更新
-        
-    except Exception as e:
-        print(f"！！！エラー：ループ処理中に何か起きました: {e}")
-        await bot.change_presence(status=discord.Status.invisible)
-        last_checked_time = datetime.now(JST) # エラー時も時間は更新
-        last_mention_check_time = datetime.now(JST) # エラー時も時間は更新
-
-
-# ----------------------------------------
-# Botが起動したときに呼ばれる処理
-# ----------------------------------------
-@bot.event
-async def on_ready():
-    global last_checked_time, JST, TARGET_CHANNEL_ID_STR, FIRST_BOOT_FLAG_FILE, model, last_mention_check_time, HARU_SYSTEM_PROMPT
-    
-    print(f'--- {bot.user} (ハル) がDiscordにログインしました ---')
-    print('受験期モード、起動します...')
-
-    # ----------------------------------
-    # ★★★ 初回起動メッセージ ★★★
-    # ----------------------------------
-    if not TARGET_CHANNEL_ID_STR:
-        print("！！！警告： TARGET_CHANNEL_ID が設定されてないため、初回起動メッセージは送れません。")
-    else:
-        if not os.path.exists(FIRST_BOOT_FLAG_FILE):
-            print("★★★ 初回起動を検知！ ★★★")
-            try:
-                target_channel_id_int = int(TARGET_CHANNEL_ID_STR)
-                channel = bot.get_channel(target_channel_id_int)
-                if channel:
-                    
-                    # ★★★ プロンプト修正！ ★★★
-                    prompt = f"""{HARU_SYSTEM_PROMPT}
-                    
-【ミッション】
-君（ハル）は、今日からこのDiscordサーバーに初めて参加しました。
-『よろしく！』みたいな、初参加の挨拶を生成してください。
-"""
-                    
-                    async with channel.typing():
-                        await asyncio.sleep(random.randint(10, 20))
-                    
-                    response = await model.generate_content_async(prompt) 
-                    await channel.send(response.text)
-                    print(f"初回起動メッセージを {channel.name} に送信しました。")
-                    
-                    with open(FIRST_BOOT_FLAG_FILE, 'w') as f:
-                        f.write(datetime.now(JST).isoformat())
-                    print(f"「{FIRST_BOOT_FLAG_FILE}」を作成しました。もう初回起動メッセージは送りません。")
-                
-                else:
-                    print(f"！！！エラー： 初回起動メッセージを送るチャンネルID ({TARGET_CHANNEL_ID_STR}) が見つかりません。")
-            
-            except Exception as e:
-                print(f"！！！エラー： 初回起動メッセージの送信に失敗しました: {e}")
-        else:
-            print(f"「{FIRST_BOOT_FLAG_FILE}」が存在するため、初回起動メッセージはスキップします。")
-
-    # ----------------------------------
-
-    print("チェック時間を現在時刻に初期化します。")
-    last_checked_time = datetime.now(JST) - timedelta(days=1) # 「浮上」時間は昨日（日付リセットのため）
-    last_mention_check_time = datetime.now(JST) # 「メンション」は今（これ以降のメンションを拾う）
-    
-    check_activity_loop.start()
-    await bot.change_presence(status=discord.Status.invisible)
-
-# ----------------------------------------
-# Botを起動！
-# ----------------------------------------
-if DISCORD_TOKEN and GEMINI_API_KEY:
-    try:
-        print("「ハル」を起動します...")
-        # ★★★ トークンエラーがここで起きるなら、大文字小文字、コピペミス、権限設定が原因！ ★★★
-        bot.run(DISCORD_TOKEN)
-    except discord.errors.LoginFailure as e:
-        print("！！！エラー： ログインに失敗しました (LoginFailure)。")
-        print("！！！原因： Discordトークンが間違っているか、古いです。Renderの環境変数を見直して！")
-    except discord.errors.PrivilegedIntentsRequired as e:
-        print("！！！エラー： 権限が足りません (PrivilegedIntentsRequired)。")
-        print("！！！原因： Discord Developer Portal の「MESSAGE CONTENT INTENT」がONになっていません！")
-    except Exception as e:
-        print(f"！！！エラー：Botの起動に失敗しました。: {e}")
-else:
-    print("！！！エラー： DISCORD_TOKEN か GEMINI_API_KEY が .env (Secrets) に設定されていません。")
+import discord
+import os
+import json
+import random
+import asyncio
+import functools
+import heapq
+import contextlib
+import contextvars
+import logging
+import time as time_module
+import sqlite3
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, time
+import pytz # タイムゾーン扱うために追加
+from dotenv import load_dotenv
+
+# ----------------------------------------
+# ★★★ 設定（環境変数を読むのは main() で1回だけ。import しただけでは何も起きない） ★★★
+# ----------------------------------------
+class ConfigError(Exception):
+    """設定（環境変数）がおかしいので起動できない。problems に全部入ってる"""
+
+    def __init__(self, problems):
+        super().__init__("\n".join(problems))
+        self.problems = problems
+
+
+TRUE_VALUES = ("1", "true", "yes", "on")   # フラグの環境変数で「オン」と読む値
+FALSE_VALUES = ("0", "false", "no", "off")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """起動時に1回だけ環境変数から読む設定。途中で変えない（変えるときは configure で丸ごと入れ替える）"""
+    discord_token: str = ""
+    gemini_api_key: str = ""
+    target_channel_id: str = ""                    # 発言するチャンネルID（1個だけのとき。昔のフラグファイルの引き継ぎにも使う）
+    target_channel_ids: tuple[int, ...] = ()       # 複数チャンネルなら TARGET_CHANNEL_IDS にカンマ区切り
+    channel_schedules: dict = field(default_factory=dict) # チャンネルごとの浮上スケジュール（{"チャンネルID": {WAKE_SCHEDULE の上書き}}）
+    state_db_path: str = "haru_state.db"           # 再起動しても状態を忘れないためのSQLite
+    wake_concurrency: int = 4                      # 同時に浮上処理するチャンネル数の上限
+    gemini_model_name: str = "gemini-1.5-flash"
+    gemini_context_cache: bool = False             # ペルソナをGemini側にキャッシュする（キャッシュできる最小サイズ以上のときだけ効く）
+    gemini_cache_model_name: str = "gemini-1.5-flash-002" # キャッシュはバージョン付きのモデル名じゃないとダメ
+    gemini_cache_ttl_minutes: int = 60
+    gemini_timeout_seconds: float = 30.0           # 1回の呼び出しのタイムアウト
+    gemini_max_in_flight: int = 4                  # 同時に投げるリクエストの上限
+    gemini_rate_per_minute: float = 15.0           # 1分あたりのリクエスト上限（無料枠はだいたい15）
+    gemini_max_retries: int = 3
+    gemini_warmup: bool = True                     # 起動時に1回軽く呼んで接続を温めておく（APIキーの確認にもなる）
+    log_level: str = "INFO"                        # DEBUG にすると各ステージの時間も出る
+    log_format: str = "text"                       # json にすると1行1JSONで出る
+    metrics_port: int = 0                          # 0 以外なら http://metrics_host:metrics_port/metrics でPrometheus形式を出す
+    metrics_host: str = "127.0.0.1"
+    metrics_textfile: str | None = None            # node_exporter の textfile collector 用（浮上のたびに書き出す）
+    mention_batch_mode: bool = True                # 溜まったメンションを1回のGemini呼び出しでまとめて処理する
+    quick_skip_enabled: bool = True                # 「おつー」みたいな見ればわかるスルーは、Geminiに聞かずに手元で決める
+    quick_skip_extra_phrases: tuple[str, ...] = () # スルー扱いにする言い回しの追加（ログを見ながら調整する用）
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        """環境変数から読んで、チェックまでする。おかしいところは全部まとめて ConfigError にする"""
+        problems = []
+
+        def number(name, default, cast):
+            value = environ.get(name, "").strip()
+            if not value:
+                return default
+            try:
+                return cast(value)
+            except ValueError:
+                problems.append(f"{name} が数字になっていません: {value!r}")
+                return default
+
+        def flag(name, default):
+            value = environ.get(name, "").strip().lower()
+            if not value:
+                return default
+            if value in TRUE_VALUES:
+                return True
+            if value in FALSE_VALUES:
+                return False
+            problems.append(f"{name} は 1/0・true/false・yes/no・on/off のどれかにしてください: {value!r}")
+            return default
+
+        target_channel_id = environ.get('TARGET_CHANNEL_ID', '').strip()
+        target_channel_ids = []
+        for channel_id_str in environ.get('TARGET_CHANNEL_IDS', target_channel_id).split(','):
+            channel_id_str = channel_id_str.strip()
+            if not channel_id_str:
+                continue
+            try:
+                target_channel_ids.append(int(channel_id_str))
+            except ValueError:
+                problems.append(f"チャンネルIDが無効です: {channel_id_str!r}")
+
+        try:
+            channel_schedules = json.loads(environ.get('CHANNEL_SCHEDULES') or '{}')
+        except json.JSONDecodeError as e:
+            problems.append(f"CHANNEL_SCHEDULES がJSONになっていません: {e}")
+            channel_schedules = {}
+
+        settings = cls(
+            discord_token=environ.get('DISCORD_TOKEN', ''),
+            gemini_api_key=environ.get('GEMINI_API_KEY', ''),
+            target_channel_id=target_channel_id,
+            target_channel_ids=tuple(target_channel_ids),
+            channel_schedules=channel_schedules,
+            state_db_path=environ.get('STATE_DB_PATH') or cls.state_db_path,
+            wake_concurrency=number('WAKE_CONCURRENCY', cls.wake_concurrency, int),
+            gemini_model_name=environ.get('GEMINI_MODEL_NAME') or cls.gemini_model_name,
+            gemini_context_cache=flag('GEMINI_CONTEXT_CACHE', cls.gemini_context_cache),
+            gemini_cache_model_name=environ.get('GEMINI_CACHE_MODEL_NAME') or cls.gemini_cache_model_name,
+            gemini_cache_ttl_minutes=number('GEMINI_CACHE_TTL_MINUTES', cls.gemini_cache_ttl_minutes, int),
+            gemini_timeout_seconds=number('GEMINI_TIMEOUT_SECONDS', cls.gemini_timeout_seconds, float),
+            gemini_max_in_flight=number('GEMINI_MAX_IN_FLIGHT', cls.gemini_max_in_flight, int),
+            gemini_rate_per_minute=number('GEMINI_RATE_PER_MINUTE', cls.gemini_rate_per_minute, float),
+            gemini_max_retries=number('GEMINI_MAX_RETRIES', cls.gemini_max_retries, int),
+            gemini_warmup=flag('GEMINI_WARMUP', cls.gemini_warmup),
+            log_level=environ.get('LOG_LEVEL') or cls.log_level,
+            log_format=environ.get('LOG_FORMAT') or cls.log_format,
+            metrics_port=number('METRICS_PORT', cls.metrics_port, int),
+            metrics_host=environ.get('METRICS_HOST') or cls.metrics_host,
+            metrics_textfile=environ.get('METRICS_TEXTFILE') or None,
+            mention_batch_mode=flag('MENTION_BATCH_MODE', cls.mention_batch_mode),
+            quick_skip_enabled=flag('QUICK_SKIP_ENABLED', cls.quick_skip_enabled),
+            quick_skip_extra_phrases=tuple(p.strip() for p in environ.get('QUICK_SKIP_EXTRA_PHRASES', '').split(',') if p.strip()),
+        )
+        problems += settings.problems()
+        if problems:
+            raise ConfigError(problems)
+        return settings
+
+    def problems(self):
+        """足りない・範囲外の値のリスト（空なら起動してOK）"""
+        problems = []
+        if not self.discord_token or not self.gemini_api_key:
+            problems.append("DISCORD_TOKEN か GEMINI_API_KEY が .env (Secrets) に設定されていません。")
+        if not isinstance(self.channel_schedules, dict) or not all(isinstance(v, dict) for v in self.channel_schedules.values()):
+            problems.append('CHANNEL_SCHEDULES は {"チャンネルID": {...}} の形にしてください。')
+        else:
+            for channel_id_str, overrides in self.channel_schedules.items():
+                problems += schedule_problems(channel_id_str, overrides)
+        if self.wake_concurrency < 1:
+            problems.append("WAKE_CONCURRENCY は1以上にしてください。")
+        if self.gemini_max_in_flight < 1:
+            problems.append("GEMINI_MAX_IN_FLIGHT は1以上にしてください。")
+        if self.gemini_rate_per_minute <= 0 or self.gemini_timeout_seconds <= 0:
+            problems.append("GEMINI_RATE_PER_MINUTE と GEMINI_TIMEOUT_SECONDS は0より大きくしてください。")
+        if self.gemini_max_retries < 0:
+            problems.append("GEMINI_MAX_RETRIES は0以上にしてください。")
+        if not isinstance(logging.getLevelName(self.log_level.upper()), int):
+            problems.append(f"LOG_LEVEL が無効です: {self.log_level!r}")
+        if self.log_format not in ("text", "json"):
+            problems.append(f"LOG_FORMAT は text か json にしてください: {self.log_format!r}")
+        if not 0 <= self.metrics_port <= 65535:
+            problems.append(f"METRICS_PORT が範囲外です: {self.metrics_port}")
+        return problems
+
+
+settings = Settings() # main() で環境変数から読んだものに入れ替わる（ベンチは自分で作って configure に渡す）
+
+# --- Botの設定 ---
+# ★★★ トークンエラー対策：権限（Intents）をちゃんと設定！ ★★★
+intents = discord.Intents.default()
+intents.messages = True         # メッセージの受信
+intents.message_content = True  # ★★★ Discord Developer PortalでONにする！ ★★★
+intents.guilds = True           # サーバー情報（チャンネル履歴とか）
+intents.members = True          # メンバー情報（メンション確認とか）
+bot = discord.Client(intents=intents)
+
+# --- Botが使う変数（状態はチャンネルごとに ChannelState に持つ） ---
+JST = pytz.timezone('Asia/Tokyo')
+channel_states = {}            # channel_id -> ChannelState（on_ready で作る）
+
+
+class Clock:
+    """今の時間と「待つ」の入口。ベンチマーク（bench_haru.py）では止めた時計に差し替える"""
+
+    def now(self):
+        return datetime.now(JST)
+
+    def monotonic(self):
+        return time_module.monotonic()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+clock = Clock()
+
+
+# ----------------------------------------
+# ★★★ ログ（構造化）とメトリクス（Prometheus形式） ★★★
+# ----------------------------------------
+logger = logging.getLogger("haru")
+log_channel_id = contextvars.ContextVar("log_channel_id", default=None) # 浮上中のチャンネル（ログに自動で付く）
+
+
+class StructuredFormatter(logging.Formatter):
+    """text: 「時間 レベル [ch=…] メッセージ key=value」 / json: 1行1JSON"""
+
+    def __init__(self, fmt_type="text"):
+        super().__init__()
+        self.fmt_type = fmt_type
+
+    def format(self, record):
+        fields = {}
+        channel_id = log_channel_id.get()
+        if channel_id is not None:
+            fields["channel_id"] = channel_id
+        fields.update(getattr(record, "fields", {}))
+        timestamp = datetime.fromtimestamp(record.created, JST).isoformat(timespec="milliseconds")
+        if self.fmt_type == "json":
+            payload = {"ts": timestamp, "level": record.levelname, "msg": record.getMessage(), **fields}
+            if record.exc_info:
+                payload["exc"] = self.formatException(record.exc_info)
+            return json.dumps(payload, ensure_ascii=False, default=str)
+        line = f"{timestamp} {record.levelname:<7} {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def setup_logging(level=Settings.log_level, fmt_type=Settings.log_format):
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(StructuredFormatter(fmt_type))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level.upper())
+
+
+class Metrics:
+    """カウンター・ゲージ・ヒストグラムを貯めて、Prometheusのテキスト形式で出す"""
+
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.counters = {}   # (name, labels) -> 値
+        self.gauges = {}
+        self.histograms = {} # (name, labels) -> [バケットごとの数, 合計, 件数]
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def _labels(cls, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{cls._escape(value)}"' for key, value in pairs) + "}"
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                help_kind, text = self.help.get(name, (kind, name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {help_kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (bucket_counts, total, count) in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for bound, bucket_count in zip(self.BUCKETS, bucket_counts):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("haru_stage_duration_seconds", "histogram", "ステージ（C1/A/B/C2/D/履歴/生成/送信…）ごとの所要時間")
+metrics.describe("haru_stage_total", "counter", "ステージごとの実行回数（outcome=ok/error）")
+metrics.describe("haru_gemini_calls_total", "counter", "Gemini呼び出し回数（mission / outcome ごと）")
+metrics.describe("haru_gemini_tokens_total", "counter", "Geminiのトークン数（mission / kind=prompt,cached,response ごと）")
+metrics.describe("haru_logic_decisions_total", "counter", "ロジックA/Bの判断結果（reply / skip / no_candidates / no_new_messages）")
+metrics.describe("haru_gemini_retries_total", "counter", "Gemini呼び出しのリトライ回数")
+metrics.describe("haru_gemini_breaker_open", "gauge", "ブレーカーが落ちてたら1")
+metrics.describe("haru_gemini_calls_avoided_total", "counter", "手元の一次判定でGeminiを呼ばずに済んだ回数（mission ごと）")
+metrics.describe("haru_quick_skip_messages_total", "counter", "一次判定したメッセージ数（logic / verdict ごと。ask はGeminiに回したぶん）")
+metrics.describe("haru_stream_cutoffs_total", "counter", "「スルー」と分かった時点でストリームを打ち切った回数")
+metrics.describe("haru_gemini_warmup_total", "counter", "起動時のウォームアップの結果（outcome=ok/error）")
+metrics.describe("haru_gemini_warmup_seconds", "gauge", "起動時のウォームアップにかかった時間")
+metrics.describe("haru_scheduler_failures_total", "counter", "浮上スケジューラが例外で止まった回数")
+metrics.describe("haru_backfill_truncated_total", "counter", "穴埋めの履歴が上限（BACKFILL_LIMIT）に達して、続きを次の浮上に回した回数")
+metrics.describe("haru_startup_seconds", "gauge", "main() から最初の準備完了（on_ready の最後）までの時間")
+
+
+@contextlib.contextmanager
+def span(stage):
+    """ステージの時間を測って、ヒストグラムとカウンターに入れる（DEBUGログにも出す）"""
+    start = clock.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = clock.monotonic() - start
+        metrics.observe("haru_stage_duration_seconds", elapsed, stage=stage)
+        metrics.inc("haru_stage_total", stage=stage, outcome=outcome)
+        logger.debug("span", extra={"fields": {"stage": stage, "seconds": round(elapsed, 3), "outcome": outcome}})
+
+
+async def handle_metrics_request(reader, writer):
+    """ちっちゃいHTTPサーバー：GET /metrics だけ返す"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass # ヘッダーは読み捨て
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+metrics_server = None # on_ready で1回だけ立ち上げる
+
+
+async def start_metrics_server():
+    server = await asyncio.start_server(handle_metrics_request, settings.metrics_host, settings.metrics_port)
+    logger.info(f"メトリクスを http://{settings.metrics_host}:{settings.metrics_port}/metrics で公開します。")
+    return server
+
+
+def write_metrics_textfile(path=None):
+    """textfile collector 用に書き出す（途中の状態を読まれないように、一時ファイル→rename）"""
+    path = path or settings.metrics_textfile
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(metrics.render())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"！！！警告： メトリクスのファイル書き出しに失敗しました: {e}")
+
+# ★★★ メンション待ち行列（on_message で貯めて、浮上時にまとめて取り出す） ★★★
+MAX_PENDING_MENTIONS = 100
+
+# ★★★ メッセージキャッシュ（チャンネルごとの直近ログを手元に持っておく） ★★★
+MESSAGE_CACHE_SIZE = 50 # 1チャンネルあたり何件まで覚えておくか
+
+
+class CachedMessage:
+    """キャッシュに入れる、メッセージの必要なところだけ"""
+    __slots__ = ('message_id', 'author_id', 'author_name', 'content', 'created_at')
+
+    def __init__(self, message_id, author_id, author_name, content, created_at):
+        self.message_id = message_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.created_at = created_at
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.id, message.author.id, message.author.display_name, message.content, message.created_at)
+
+
+class MessageCache:
+    """チャンネルごとの固定長リングバッファ。ゲートウェイのイベントで更新して、履歴APIを叩かずに文脈を作る"""
+
+    def __init__(self, size=MESSAGE_CACHE_SIZE):
+        self.size = size
+        self.channels = {}   # channel_id -> deque[CachedMessage]（古い順）
+        self.seeded = set()  # 起動時の履歴取得が済んだチャンネル
+
+    def _buffer(self, channel_id):
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            buffer = self.channels[channel_id] = deque(maxlen=self.size)
+        return buffer
+
+    def add(self, message):
+        buffer = self._buffer(message.channel.id)
+        if buffer and buffer[-1].message_id >= message.id:
+            self.merge(message.channel.id, [message]) # 順番が前後したときだけ並べ直す
+            return
+        buffer.append(CachedMessage.from_message(message))
+
+    def merge(self, channel_id, messages):
+        """履歴から取ったメッセージを混ぜる（重複は捨てて、古い順に並べ直す）"""
+        buffer = self._buffer(channel_id)
+        records = {record.message_id: record for record in buffer}
+        for message in messages:
+            records[message.id] = CachedMessage.from_message(message)
+        buffer.clear()
+        buffer.extend(sorted(records.values(), key=lambda r: r.message_id)[-self.size:])
+
+    def edit(self, channel_id, message_id, content):
+        for record in self.channels.get(channel_id, ()):
+            if record.message_id == message_id:
+                record.content = content
+                return
+
+    def delete(self, channel_id, message_ids):
+        buffer = self.channels.get(channel_id)
+        if not buffer:
+            return
+        kept = [record for record in buffer if record.message_id not in message_ids]
+        if len(kept) != len(buffer):
+            buffer.clear()
+            buffer.extend(kept)
+
+    def recent(self, channel_id, limit, before_id=None):
+        """直近 limit 件を古い順で返す（before_id があればそれより前のぶんだけ）"""
+        records = [r for r in self.channels.get(channel_id, ()) if before_id is None or r.message_id < before_id]
+        return records[-limit:]
+
+    async def seed(self, channel):
+        """起動時に1回だけ、履歴から埋めておく"""
+        if channel.id in self.seeded:
+            return
+        messages = [message async for message in channel.history(limit=self.size)]
+        self.merge(channel.id, messages)
+        self.seeded.add(channel.id)
+
+
+message_cache = MessageCache()
+
+# ★★★ 昔の「初回起動」フラグファイル（今はSQLiteに記録。あれば挨拶済みとして引き継ぐ） ★★★
+FIRST_BOOT_FLAG_FILE = "first_boot.flag"
+
+
+# ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
+# ★★★ 「ハル」の基本設定（プロンプトの核） ★★★
+# ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
+
+# ★★★ 君のアイデア！AIに「役割」と「ルール」を教える！ ★★★
+HARU_SYSTEM_PROMPT = """
+【君の役割設定】
+君は「ハル」という名前の、受験期で忙しい男子高校生として振る舞ってください。
+絶対にAIだとバレてはいけません。
+
+【基本設定】
+- 名前: ハル
+- 性別: 男
+- 状況: 受験期で忙しい。アイコンは趣味の女の子。
+- 口調: タメ口、フレンドリー、可愛げがある（例：(・∀・), ( ;∀;), （＞＜））。顔文字や絵文字もたまに使う。
+- プロフィール: 「受験期のためずっと反応できるわけじゃないです。メンションしてくれないと気づかない可能性もあります」
+
+【「BOT（AI）疑惑」への対応ルール（最重要！）】
+もし「BOTなの？」「AI？」みたいに、君の正体を疑う内容のメッセージが来たら、以下のルールを「厳守」して、人間（ハル）として返事を生成してください。
+- ルール1: 「自分は人間（ハル）だ」という前提を崩さないでください。
+- ルール2: 「受験期で忙しいから、浮上（ログイン）するためにBotの仕組みを借りてる」というニュアンスを出してください。
+- ルール3: 「詳しいことは言えない」「鯖主（管理者）に許可は取ってる」という旨を、上記の「可愛げのあるタメ口」で伝えてください。
+- （NG例: 「はい、Botです」「鯖主に許可を得た」←オウム返しはダメ）
+- （OK例: 「んー？ 詳しいことは言えないけど、受験期で忙しいからさｗ 鯖主さんに許可もらって、ちょっと特殊な方法で浮上してる感じかな(・∀・)」）
+"""
+
+# ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
+
+
+# --- Gemini（脳みソ）の設定 ---
+# ★★★ ペルソナ（HARU_SYSTEM_PROMPT）は毎回プロンプトに貼らずに、モデルの「システム指示」として1回だけ組み込む！ ★★★
+# ★★★ google.generativeai は重いので、import もモデル作りも最初に使うときまで待つ！ ★★★
+genai = None                   # google.generativeai（load_genai で入る）
+model = None                   # ペルソナ入りのモデル（get_model で作る）
+gemini_cache = None            # コンテキストキャッシュ（GEMINI_CONTEXT_CACHE=1 のときだけ）
+gemini_cache_expire_time = None
+GEMINI_CACHE_EXPIRY_MARGIN = timedelta(minutes=2) # サーバー側で期限が切れる少し前に作り直す
+
+
+def load_genai():
+    """google.generativeai を import して、APIキーを設定する（最初の1回だけ）"""
+    global genai, RETRYABLE_ERRORS
+    if genai is None:
+        import google.generativeai
+        from google.api_core import exceptions as google_exceptions
+        google.generativeai.configure(api_key=settings.gemini_api_key)
+        RETRYABLE_ERRORS = RETRYABLE_ERRORS + (
+            google_exceptions.ResourceExhausted,
+            google_exceptions.TooManyRequests,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+        )
+        genai = google.generativeai
+    return genai
+
+
+def get_model():
+    global model
+    if model is None:
+        model = build_model()
+    return model
+
+
+def build_model():
+    """ペルソナ入りのモデルを作る。キャッシュが使えるならキャッシュ経由にする"""
+    global gemini_cache, gemini_cache_expire_time
+    load_genai()
+    if settings.gemini_context_cache:
+        try:
+            from google.generativeai import caching
+            ttl = timedelta(minutes=settings.gemini_cache_ttl_minutes)
+            created_at = clock.now() # 期限はサーバー側で作られた時から数えるので、呼ぶ前の時間を基準にする
+            gemini_cache = caching.CachedContent.create(
+                model=f"models/{settings.gemini_cache_model_name}",
+                display_name="haru-persona",
+                system_instruction=HARU_SYSTEM_PROMPT,
+                ttl=ttl,
+            )
+            # 期限ぴったりまで使うと、時計のズレや通信の遅れでサーバー側だけ先に切れてることがある
+            gemini_cache_expire_time = created_at + ttl - min(GEMINI_CACHE_EXPIRY_MARGIN, ttl / 2)
+            logger.info(f"ペルソナをGeminiにキャッシュしました（{settings.gemini_cache_ttl_minutes}分）。")
+            return genai.GenerativeModel.from_cached_content(cached_content=gemini_cache)
+        except Exception as e:
+            # ペルソナが短すぎる（最小トークン数未満）とかでキャッシュできないときは普通のシステム指示で
+            logger.warning(f"！！！警告： ペルソナのキャッシュに失敗したので、普通のシステム指示を使います: {e}")
+            gemini_cache = None
+            gemini_cache_expire_time = None
+    return genai.GenerativeModel(settings.gemini_model_name, system_instruction=HARU_SYSTEM_PROMPT)
+
+
+# ----------------------------------------
+# ★★★ トークン計測（ミッションごと・1日ごとに集計する） ★★★
+# ----------------------------------------
+class TokenUsage:
+    """Geminiの呼び出しごとの prompt / response / cached トークン数を1日ぶん貯めておく"""
+
+    def __init__(self):
+        self.reset()
+
+    def roll_over(self, now):
+        """日付が変わってたら、昨日のぶんを出してからリセット（チャンネルがいくつあっても1回だけ）"""
+        if self.day != now.date():
+            if self.calls or self.avoided:
+                logger.info(self.summary())
+            self.reset()
+
+    def reset(self):
+        self.day = clock.now().date()
+        self.calls = 0
+        self.by_mission = {} # mission -> [呼び出し回数, prompt, response, cached]
+        self.avoided = {}    # mission -> 手元の判定で呼ばずに済んだ回数
+
+    def record(self, mission, usage):
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        response_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+        totals = self.by_mission.setdefault(mission, [0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += prompt_tokens
+        totals[2] += response_tokens
+        totals[3] += cached_tokens
+        self.calls += 1
+        metrics.inc("haru_gemini_tokens_total", prompt_tokens, mission=mission, kind="prompt")
+        metrics.inc("haru_gemini_tokens_total", cached_tokens, mission=mission, kind="cached")
+        metrics.inc("haru_gemini_tokens_total", response_tokens, mission=mission, kind="response")
+        logger.debug(f"[トークン] {mission}: prompt={prompt_tokens} (cached={cached_tokens}) response={response_tokens}")
+
+    def record_avoided(self, mission):
+        self.avoided[mission] = self.avoided.get(mission, 0) + 1
+        metrics.inc("haru_gemini_calls_avoided_total", mission=mission)
+
+    def summary(self):
+        lines = [f"[トークン] 今日の合計（{self.calls}回）"]
+        for mission, (calls, prompt_tokens, response_tokens, cached_tokens) in sorted(self.by_mission.items()):
+            lines.append(f"  {mission}: {calls}回 prompt={prompt_tokens} (cached={cached_tokens}) response={response_tokens}")
+        for mission, count in sorted(self.avoided.items()):
+            lines.append(f"  {mission}: 手元の判定で {count}回 呼ばずに済んだ")
+        return "\n".join(lines)
+
+
+token_usage = TokenUsage()
+
+
+# ----------------------------------------
+# ★★★ 打たれ強いGemini呼び出し（タイムアウト・同時数・レート・リトライ・ブレーカー） ★★★
+# ----------------------------------------
+class GeminiUnavailable(Exception):
+    """Geminiが今は使えない（ブレーカーが落ちてる or リトライしてもダメだった）。次の浮上でやり直す"""
+
+
+# リトライすれば通るかもしれないエラー（429 / 5xx / タイムアウト）。google のぶんは load_genai で足す
+RETRYABLE_ERRORS = (asyncio.TimeoutError,)
+
+
+class TokenBucket:
+    """1分あたり rate_per_minute 回まで。貯まってるぶんだけ連続で呼べる"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(rate_per_minute, 1)
+        self.tokens = self.capacity
+        self.updated = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = asyncio.get_running_loop().time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """続けて failure_threshold 回失敗したら reset_timeout 秒はGeminiを呼ばない（落ちてるAPIを叩き続けない）。
+    時間が経ったら1回だけお試しで通して、成功したら元に戻す"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if asyncio.get_running_loop().time() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+            return False
+        self.trial_in_flight = True # お試しの1回（half-open）
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        metrics.set_gauge("haru_gemini_breaker_open", 0)
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"！！！警告： Geminiが{self.failures}回続けて失敗したので、{self.reset_timeout}秒お休みします。")
+            self.opened_at = asyncio.get_running_loop().time()
+            metrics.set_gauge("haru_gemini_breaker_open", 1)
+
+
+class GeminiClient:
+    """全部のGemini呼び出しが通る入口"""
+
+    def __init__(self, timeout=Settings.gemini_timeout_seconds, max_in_flight=Settings.gemini_max_in_flight,
+                 rate_per_minute=Settings.gemini_rate_per_minute, max_retries=Settings.gemini_max_retries,
+                 backoff_base=1.0, backoff_max=30.0):
+        self.timeout = timeout
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.bucket = TokenBucket(rate_per_minute)
+        self.breaker = CircuitBreaker()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff_delay(self, attempt):
+        """ジッター付きの指数バックオフ（full jitter）"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def call(self, request):
+        """request() はコルーチンを返す関数（リトライのたびに作り直す）"""
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise GeminiUnavailable("ブレーカーが落ちてます")
+            await self.bucket.acquire()
+            try:
+                async with self.in_flight:
+                    response = await asyncio.wait_for(request(), timeout=self.timeout)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise GeminiUnavailable(f"{self.max_retries}回リトライしてもダメでした: {e!r}") from e
+                delay = self.backoff_delay(attempt)
+                metrics.inc("haru_gemini_retries_total")
+                logger.warning(f"！！！警告： Geminiの呼び出しに失敗（{e!r}）。{delay:.1f}秒後にリトライします。")
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                self.breaker.trial_in_flight = False # リトライしても無駄なエラーはブレーカーには数えない
+                raise
+            self.breaker.record_success()
+            return response
+
+
+gemini_client = GeminiClient()
+
+
+model_lock = asyncio.Lock() # モデルの作り直しは1回に1つだけ（キャッシュを何個も作らない）
+
+
+async def ensure_model():
+    """モデルがまだなら作る。キャッシュの期限が切れてたら作り直す。
+    どっちも重い（import・CachedContent.create の通信）ので、イベントループを止めないように別スレッドで"""
+    global model
+    async with model_lock:
+        if gemini_cache_expire_time and clock.now() >= gemini_cache_expire_time:
+            model = await asyncio.to_thread(build_model)
+        elif model is None:
+            await asyncio.to_thread(get_model)
+
+
+async def call_gemini(mission, request):
+    """全ミッション共通のGemini呼び出し口。request() はコルーチンを返す関数（中で model を使う）"""
+    await ensure_model()
+    outcome = "error"
+    try:
+        with span("generate"):
+            response = await gemini_client.call(request)
+        outcome = "ok"
+    except GeminiUnavailable:
+        outcome = "unavailable"
+        raise
+    finally:
+        metrics.inc("haru_gemini_calls_total", mission=mission, outcome=outcome)
+    return response
+
+
+async def generate(mission, prompt, **kwargs):
+    """普通の（ストリーミングしない）生成。トークン数もここで記録する"""
+    response = await call_gemini(mission, lambda: model.generate_content_async(prompt, **kwargs))
+    token_usage.record(mission, response.usage_metadata)
+    return response
+
+
+async def warm_up_gemini():
+    """起動時に1回だけ、軽い呼び出し（count_tokens）で接続を温めておく。
+    最初の浮上で import やTLSの握手を待たなくて済むし、APIキーが違ってたらここで分かる"""
+    start = clock.monotonic()
+    try:
+        await ensure_model()
+        await asyncio.wait_for(model.count_tokens_async("ping"), timeout=settings.gemini_timeout_seconds)
+    except Exception as e:
+        logger.error(f"！！！エラー：Geminiに接続できませんでした。APIキーは合ってる？: {e}")
+        metrics.inc("haru_gemini_warmup_total", outcome="error")
+        return
+    elapsed = clock.monotonic() - start
+    metrics.inc("haru_gemini_warmup_total", outcome="ok")
+    metrics.set_gauge("haru_gemini_warmup_seconds", elapsed)
+    logger.info(f"Gemini（脳みソ）の準備OK！（ウォームアップ {elapsed:.2f}秒）")
+
+
+async def generate_text(mission, prompt, **kwargs):
+    response = await generate(mission, prompt, **kwargs)
+    return response.text
+
+
+# ----------------------------------------
+# ★★★ 「返事 or スルー」の判定（ストリーミングで聞いて、スルーと分かった時点で打ち切る） ★★★
+# ----------------------------------------
+VERDICT_FORMAT = """【出力形式】
+以下のJSON「だけ」を出力してください。"decision" を必ず最初に書いてください。
+{"decision": "返事" または "スルー", "reply": "返事の本文（スルーなら空文字）"}"""
+DECISION_RE = re.compile(r'"decision"\s*:\s*"(返事|スルー)"')
+
+
+def parse_verdict(text):
+    """Geminiの返事（JSON）を 返事の本文 or None(スルー) にする。判定が読めなかったら ValueError"""
+    match = DECISION_RE.search(text)
+    if match is None:
+        raise ValueError(f"判定（decision）が見つかりません: {text[:100]!r}")
+    if match.group(1) == "スルー":
+        return None # 途中で打ち切ったぶんはJSONとして閉じてないので、読むのはここまで
+    try:
+        item = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"返事がJSONになっていません: {text[:100]!r}") from e
+    reply = item.get("reply") if isinstance(item, dict) else None
+    if not isinstance(reply, str) or not reply.strip():
+        return None # 「返事」なのに本文が空なら、スルー扱い
+    return reply.strip()
+
+
+async def generate_verdict(mission, prompt):
+    """返事するかどうかをストリーミングで聞く。返事の本文 or None(スルー)。
+    "decision" が「スルー」だと分かったらストリームを閉じて、残りは生成させない"""
+    usage = None
+
+    async def read_stream():
+        nonlocal usage
+        usage = None
+        text = ""
+        response = await model.generate_content_async(
+            prompt, stream=True, generation_config={"response_mime_type": "application/json"})
+        chunks = response.__aiter__()
+        try:
+            async for chunk in chunks:
+                try:
+                    text += chunk.text
+                except ValueError:
+                    pass # 中身のないチャンク（最後の集計だけ、など）
+                usage = chunk.usage_metadata or usage
+                match = DECISION_RE.search(text)
+                if match and match.group(1) == "スルー":
+                    metrics.inc("haru_stream_cutoffs_total", mission=mission)
+                    break
+        finally:
+            await chunks.aclose()
+        return text
+
+    text = await call_gemini(mission, read_stream)
+    token_usage.record(mission, usage)
+    return parse_verdict(text)
+
+
+# ----------------------------------------
+# ★★★ 「入力中…」と生成を並行させる送信 ★★★
+# (typing の待ち時間 + Geminiの待ち時間 → 遅い方だけ待てばいい)
+# ----------------------------------------
+def start_typing_delay():
+    """人間っぽい待ち時間（10～20秒）を今から数え始める"""
+    return asyncio.ensure_future(clock.sleep(random.randint(10, 20)))
+
+
+async def send_after_typing(channel, text, typing_delay=None, **send_kwargs):
+    """「入力中…」を出しながら待って送る。
+    text が生成中のコルーチンなら待ち時間と同時に走らせて、遅い方が終わったら送る。
+    typing_delay を先に始めておけば、その残り時間だけ待つ"""
+    if typing_delay is None:
+        typing_delay = start_typing_delay()
+    with span("typing"):
+        async with channel.typing():
+            if asyncio.iscoroutine(text):
+                text, _ = await asyncio.gather(text, typing_delay)
+            else:
+                await typing_delay
+    with span("send"):
+        await channel.send(text, **send_kwargs)
+
+
+# ----------------------------------------
+# ★★★ 手元の一次判定（見ればわかるスルーは、Geminiに聞かずに決める） ★★★
+# ----------------------------------------
+# 挨拶・相槌だけのメッセージ。表記ゆれは normalize_for_quick_skip で吸収するので、ここは素直に書いてOK
+QUICK_SKIP_PHRASES = [
+    "おつ", "おつかれ", "おつかれさま", "おつかれさまです", "おつかれさまでした", "乙",
+    "お疲れ", "お疲れさま", "お疲れ様", "お疲れ様です", "お疲れ様でした",
+    "おやすみ", "おやすみなさい", "おやす", "おはよう", "おはよ", "おは", "おはようございます",
+    "こんにちは", "こんばんは", "ばんわ", "ただいま", "おかえり", "いってきます", "いってらっしゃい",
+    "了解", "了解です", "りょ", "りょうかい", "りょーかい", "おけ", "おっけ", "おっけー", "ok", "okです",
+    "はい", "うん", "うい", "それな", "たしかに", "確かに", "なるほど",
+    "ありがと", "ありがとう", "あざす", "あざまる", "サンキュー", "thx", "ty", "lol", "gm", "gn",
+]
+DISCORD_MARKUP_RE = re.compile(r"<a?:\w+:\d+>|<[@#][!&]?\d+>") # メンション・チャンネル・カスタム絵文字
+REPEATED_CHAR_RE = re.compile(r"(.)\1+")
+TRAILING_DECORATION = "ーw草" # 「おつーーw」の「ーーw」みたいな語尾の飾り
+
+
+def normalize_for_quick_skip(content):
+    """比べやすい形にする。質問っぽい（？がある）ときは None"""
+    text = unicodedata.normalize("NFKC", DISCORD_MARKUP_RE.sub("", content)).lower()
+    if "?" in text:
+        return None
+    # 記号・絵文字・空白を落として、同じ文字の連続は1文字に（「おつーーー」→「おつー」）
+    text = "".join(ch for ch in text if unicodedata.category(ch)[0] not in "PSZC")
+    text = REPEATED_CHAR_RE.sub(r"\1", text)
+    return text.rstrip(TRAILING_DECORATION)
+
+
+class QuickSkipClassifier:
+    """ロジックA/B共通の一次判定。「見ればわかるスルー」だけ手元で決めて、迷うものはGeminiに回す"""
+
+    def __init__(self, phrases, enabled=True):
+        self.enabled = enabled
+        self.phrases = {normalize_for_quick_skip(phrase) for phrase in phrases} - {None, ""}
+
+    def classify(self, content):
+        """スルーしていい理由（"lexicon" / "emoji" / "short"）。迷うなら None"""
+        normalized = normalize_for_quick_skip(content)
+        if normalized is None:
+            return None
+        if not normalized:
+            return "emoji" # 絵文字・記号・ｗだけ
+        if normalized in self.phrases:
+            return "lexicon"
+        if len(normalized) == 1 and unicodedata.name(normalized, "").startswith(("HIRAGANA", "KATAKANA", "LATIN")):
+            return "short" # 「ん」「は」みたいな1文字
+        return None
+
+    def should_skip(self, logic, contents):
+        """contents（判断してほしいメッセージの本文）が全部スルーでいいなら True。
+        「Geminiを呼ばずに済んだ」かは呼ぶ側で決まるので、そっちで token_usage.record_avoided する"""
+        if not self.enabled or not contents:
+            return False
+        for content in contents:
+            reason = self.classify(content)
+            metrics.inc("haru_quick_skip_messages_total", logic=logic, verdict=reason or "ask")
+            logger.debug("quick_skip", extra={"fields": {"logic": logic, "verdict": reason or "ask", "content": content[:50]}})
+            if reason is None:
+                return False
+        return True
+
+
+quick_skip = QuickSkipClassifier(QUICK_SKIP_PHRASES) # 設定（追加の言い回し・オフ）は configure で反映
+
+
+# ----------------------------------------
+# ★★★ ロジックAのお手伝い（メンションの文脈づくり＆まとめて処理） ★★★
+# ----------------------------------------
+def build_mention_context(channel, mention):
+    """メンションの直前3件（キャッシュから）＋メンション本体の会話ログ"""
+    context_log = ""
+    for ctx_msg in message_cache.recent(channel.id, limit=3, before_id=mention.id):
+        context_log += f"{ctx_msg.author_name}: {ctx_msg.content}\n"
+    context_log += f"--- ここでメンション ---\n"
+    context_log += f"{mention.author.display_name}: {mention.content}\n"
+    return context_log
+
+
+def parse_batch_decisions(text, count):
+    """Geminiの返事（JSON）を {番号: 返事 or None(スルー)} にする。
+    壊れてたり、1～count の番号が1つでも抜けてたら None（抜けたメンションをスルー扱いで失くさないため）"""
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(items, list):
+        return None
+
+    decisions = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        number = item.get("no")
+        if not isinstance(number, int) or not 1 <= number <= count or number in decisions:
+            continue
+        reply = item.get("reply")
+        if item.get("decision") == "返事" and isinstance(reply, str) and reply.strip():
+            decisions[number] = reply.strip()
+        else:
+            decisions[number] = None
+    if len(decisions) != count:
+        return None
+    return decisions
+
+
+async def handle_mentions_batched(state, channel, mentions):
+    """溜まってるメンションを全部まとめて1回のGemini呼び出しで判断して、返事する。
+    全部さばけたら True（失敗したら False で、メンションは次の浮上に持ち越し）"""
+    # 見ればわかるスルーは先に片付けて、Geminiには迷うぶんだけ聞く
+    asked = []
+    for mention in mentions:
+        if quick_skip.should_skip("A", [mention.content]):
+            logger.info(f"[ロジックA] メンション (from {mention.author.display_name}) は見ればわかるスルーなので、Geminiに聞かずにスルーします。")
+            metrics.inc("haru_logic_decisions_total", logic="A", decision="skip")
+            mark_handled(state, mention.id)
+        else:
+            asked.append(mention)
+    if not asked:
+        token_usage.record_avoided("A") # 全部手元で片付いたときだけ、呼び出し1回ぶん浮いた
+        return True
+    mentions = asked
+
+    mention_logs = ""
+    for number, mention in enumerate(mentions, start=1):
+        mention_logs += f"### メンション {number}\n{build_mention_context(channel, mention)}\n"
+
+    prompt = f"""【ミッション】
+以下の会話ログで、君（ハル）宛てのメンションが {len(mentions)} 件来ました。
+メンション1件ずつについて、君の役割設定（特に「BOT疑惑への対応ルール」）に従って、以下の優先順位で判断してください。
+
+1.  **[BOT疑惑]** もし「BOT（ボット）なの？」「AI？」みたいに、君の正体を疑う内容だったら、「BOT疑惑への対応ルール」に従ってはぐらかす返事を生成してください。
+2.  **[返事する]** もし（1）じゃなくて、返事すべき内容（質問、会話の続き）なら、可愛げのある返事を生成してください。
+3.  **[スルー]** もし（1）でも（2）でもなく、スルーすべき内容（「おつー」「おやすみ」等の挨拶、ただの相槌、独り言）なら、スルーしてください。
+
+【出力形式】
+以下のJSON配列「だけ」を出力してください。メンション1件につき1要素です。
+[{{"no": メンション番号, "decision": "返事" または "スルー", "reply": "返事の本文（スルーなら空文字）"}}]
+
+【会話ログ】
+{mention_logs}"""
+    typing_delay = start_typing_delay() # 1件目の待ち時間は生成と並行で数える
+    try:
+        response = await generate("A", prompt, generation_config={"response_mime_type": "application/json"})
+        decisions = parse_batch_decisions(response.text, len(mentions)) # 安全フィルタで止められると .text が ValueError
+        if decisions is None:
+            raise ValueError("まとめ処理の返事がJSONになっていないか、判断が抜けてるメンションがありました")
+    except ValueError as e:
+        typing_delay.cancel()
+        # 失敗は一番古いメンションで数える（後から来たメンションが混ざっても、数え直しにならない）
+        if give_up_on_verdict(state, ("batch", mentions[0].id), "A", e, fallback="一番古いメンションを1件ずつ処理します"):
+            # 何回まとめても読めないので、一番古いのだけ1件ずつの処理に回す（そっちにも回数の上限がある）
+            await handle_single_mention(state, channel, mentions[0])
+        return False
+    state.verdict_failures.pop(("batch", mentions[0].id), None)
+
+    for number, mention in enumerate(mentions, start=1):
+        reply = decisions.get(number)
+        if reply is None:
+            logger.info(f"[ロジックA] メンション {number} (from {mention.author.display_name}) はスルーします。")
+            metrics.inc("haru_logic_decisions_total", logic="A", decision="skip")
+            mark_handled(state, mention.id)
+            continue
+        logger.info(f"[ロジックA] メンション {number} (from {mention.author.display_name}) に返信します。")
+        metrics.inc("haru_logic_decisions_total", logic="A", decision="reply")
+        # 何件も返すときにどれへの返事か分かるように、元のメッセージに「返信」の形で送る
+        await send_after_typing(channel, reply, typing_delay, reference=mention.to_reference(fail_if_not_exists=False))
+        mark_handled(state, mention.id) # 途中で失敗しても、送ったぶんは2回送らない
+        typing_delay = None # 2件目からは普通に待つ
+    if typing_delay:
+        typing_delay.cancel() # 全部スルーだったとき
+    return True
+
+
+# ----------------------------------------
+# ★★★ 浮上スケジュール（いつ浮上するかは「データ」で決める） ★★★
+# ----------------------------------------
+WAKE_SCHEDULE = {
+    "weekday_hours": [21, 22, 23],                 # 平日: 21時～23時
+    "holiday_hours": [18, 19, 20, 21, 22, 23],     # 休日: 18時～23時
+    "holiday_weekdays": [5, 6],                    # 休日扱いの曜日（土日）
+    "window_minutes": 10,                          # 毎時0～9分の間なら浮上OK（過ぎたら「逃した」扱い）
+    "jitter_seconds": (1, 10),                     # 毎時0分から何秒ずらして浮上するか（ランダム）
+}
+
+
+def schedule_problems(channel_id_str, overrides):
+    """CHANNEL_SCHEDULES の1チャンネルぶんを WAKE_SCHEDULE と見比べてチェックする（おかしいところのリスト）"""
+    def is_int(value, low, high):
+        return isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+
+    name = f"CHANNEL_SCHEDULES[{channel_id_str!r}]"
+    problems = []
+    if not channel_id_str.strip().isdigit():
+        problems.append(f"{name}: チャンネルIDが数字になっていません。")
+    for key, value in overrides.items():
+        if key not in WAKE_SCHEDULE:
+            problems.append(f"{name}: 知らないキーです: {key!r}（使えるのは {', '.join(WAKE_SCHEDULE)}）")
+        elif key in ("weekday_hours", "holiday_hours"):
+            if not isinstance(value, list) or not value or not all(is_int(hour, 0, 23) for hour in value):
+                problems.append(f"{name}.{key}: 0～23 の時（じ）を1つ以上並べてください: {value!r}")
+        elif key == "holiday_weekdays":
+            if not isinstance(value, list) or not all(is_int(day, 0, 6) for day in value):
+                problems.append(f"{name}.{key}: 0（月）～6（日）の曜日を並べてください: {value!r}")
+        elif key == "window_minutes":
+            if not is_int(value, 1, 60):
+                problems.append(f"{name}.{key}: 1～60 の分にしてください: {value!r}")
+        elif key == "jitter_seconds":
+            if (not isinstance(value, (list, tuple)) or len(value) != 2
+                    or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)
+                    or not 0 <= value[0] <= value[1]):
+                problems.append(f"{name}.{key}: [最小秒, 最大秒] の形にしてください: {value!r}")
+    return problems
+
+
+def get_target_hours(now, schedule=WAKE_SCHEDULE):
+    """その日の浮上する時間（時）のリスト"""
+    is_holiday = now.weekday() in schedule["holiday_weekdays"] # 土日か？
+    if is_holiday:
+        return schedule["holiday_hours"]
+    return schedule["weekday_hours"]
+
+
+class WakeScheduler:
+    """次に浮上する時刻を計算して、そこまでぐっすり寝る（60秒ごとに起きない！）。
+    浮上の窓ごとに前もって走らせるジョブ（lead_jobs）と、1回きりの追加ジョブ（add_job）もここで回す"""
+
+    MAX_SLEEP = timedelta(hours=1) # 時計のズレ対策で、最長でもこれだけ寝たら計算し直す
+
+    def __init__(self, wake, schedule=WAKE_SCHEDULE, lead_jobs=(), last_woke_at=None, now_func=None, sleep_func=None):
+        self.wake = wake                  # async def wake(slot, catch_up)
+        self.last_woke_at = last_woke_at  # 再起動前に最後に浮上した時間（同じ窓で2回浮上しない）
+        self.schedule = schedule
+        self.lead_jobs = list(lead_jobs)  # [(何分前, 名前, async def job())]
+        self.now = now_func or clock.now
+        self.sleep = sleep_func or clock.sleep
+        self.jobs = []                    # [(時刻, 連番, 名前, async def job())] のヒープ
+        self.job_seq = 0
+        self.jobs_changed = asyncio.Event()
+        self.last_slot = None
+
+    @property
+    def window(self):
+        return timedelta(minutes=self.schedule["window_minutes"])
+
+    def slots_for_day(self, day):
+        """その日の浮上の窓の開始時刻（毎時0分）のリスト"""
+        midnight = JST.localize(datetime.combine(day, time(0)))
+        return [JST.localize(datetime.combine(day, time(hour))) for hour in get_target_hours(midnight, self.schedule)]
+
+    def next_slot(self, after):
+        """after より後で、一番近い浮上の窓"""
+        day = after.date()
+        for _ in range(8): # 1週間ぶん見れば必ず見つかる
+            for slot in self.slots_for_day(day):
+                if slot > after:
+                    return slot
+            day += timedelta(days=1)
+        raise ValueError("浮上スケジュールが空っぽです。WAKE_SCHEDULE を見直して！")
+
+    def jittered(self, slot):
+        low, high = self.schedule["jitter_seconds"]
+        return slot + timedelta(seconds=random.uniform(low, high))
+
+    def add_job(self, when, name, job):
+        """1回きりのジョブを追加する（寝てる途中でも起きて計算し直す）"""
+        self.job_seq += 1
+        heapq.heappush(self.jobs, (when, self.job_seq, name, job))
+        self.jobs_changed.set()
+
+    def _plan_lead_jobs(self, slot):
+        for lead, name, job in self.lead_jobs:
+            self.add_job(max(slot - lead, self.now()), name, job)
+
+    async def _run_due_jobs(self, now):
+        while self.jobs and self.jobs[0][0] <= now:
+            _, _, name, job = heapq.heappop(self.jobs)
+            # ジョブは浮上を邪魔しないように裏で走らせる
+            asyncio.create_task(self._run_job(name, job))
+
+    async def _run_job(self, name, job):
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"！！！エラー： ジョブ「{name}」の実行中に何か起きました: {e}")
+
+    async def _sleep_until(self, when):
+        delay = min(when - self.now(), self.MAX_SLEEP).total_seconds()
+        if delay <= 0:
+            return
+        self.jobs_changed.clear()
+        sleeper = asyncio.ensure_future(self.sleep(delay))
+        changed = asyncio.ensure_future(self.jobs_changed.wait())
+        await asyncio.wait([sleeper, changed], return_when=asyncio.FIRST_COMPLETED)
+        sleeper.cancel()
+        changed.cancel()
+
+    def _skip_missed(self, slot, now):
+        """窓が閉じちゃった浮上を全部飛ばして、(逃したリスト, 次の窓) を返す"""
+        missed = []
+        while slot + self.window <= now:
+            missed.append(slot)
+            slot = self.next_slot(slot)
+        return missed, slot
+
+    async def run(self):
+        # 起動した時点でまだ開いてる窓があれば、それも対象にする（再起動前にその窓でもう浮上してたら飛ばす）
+        slot = self.next_slot(self.now() - self.window)
+        if self.last_woke_at and slot <= self.last_woke_at < slot + self.window:
+            logger.info(f"{slot.strftime('%m/%d %H:%M')} の窓は再起動前に浮上済みなので、次の窓から始めます。")
+            slot = self.next_slot(slot)
+        wake_at = self.jittered(slot)
+        self._plan_lead_jobs(slot)
+
+        while True:
+            now = self.now()
+            await self._run_due_jobs(now)
+
+            # --- 止まってた（or 浮上が長引いた）せいで窓を逃してないか？ ---
+            missed, next_slot = self._skip_missed(slot, now)
+            if missed:
+                logger.warning(f"！！！警告： 浮上の窓を {len(missed)} 個逃しました: {', '.join(m.strftime('%m/%d %H:%M') for m in missed)}")
+                # 決まったルール：同じ日のうちなら「最後に逃した窓」のぶんだけ今すぐ1回浮上する（日付をまたいだら諦める）
+                if missed[-1].date() == now.date() and next_slot > now:
+                    await self._wake(missed[-1], catch_up=True)
+                slot = next_slot
+                wake_at = self.jittered(slot)
+                self._plan_lead_jobs(slot)
+                continue
+
+            if now >= wake_at:
+                await self._wake(slot, catch_up=False)
+                slot = self.next_slot(slot)
+                wake_at = self.jittered(slot)
+                self._plan_lead_jobs(slot)
+                continue
+
+            next_job_time = self.jobs[0][0] if self.jobs else wake_at
+            await self._sleep_until(min(wake_at, next_job_time))
+
+    async def _wake(self, slot, catch_up):
+        self.last_slot = slot
+        try:
+            await self.wake(slot, catch_up)
+        except Exception as e:
+            logger.error(f"！！！エラー：浮上処理中に何か起きました: {e}")
+
+
+# ----------------------------------------
+# ★★★ 定期ツイート（C1 / C2 / D）の事前生成 ★★★
+# (浮上してからGeminiを待たなくていいように、窓が開く前に作っておく)
+# ----------------------------------------
+SCHEDULED_POST_PROMPTS = {
+    "C1": """【ミッション】
+今、君（ハル）はその日初めてDiscordに浮上しました。
+「塾終わったー疲れたー」みたいな感じの、日常ツイートを1個、生成してください。
+（例：つかれたー（＞＜）
+""",
+    "C2": """【ミッション】
+今、23時台になりました。
+「そろそろ寝るわー」みたいな感じの、おやすみツイートを1個、生成してください。
+（例：も、限界（＞＜）おやすみー！）
+""",
+    "D": """【ミッション】
+今日まだ「塾おわ」以外の日常的なツイートをしていません。
+「甘いもの食べたい」とか「今日寒いなー」みたいな、勉強とは関係ない何気ない日常ツイートを1個、生成してください。
+""",
+}
+POST_POOL_SIZE = 1                              # 種類ごとに何個まで作り置きするか（1日1回のツイートなので、余分に作ると捨てるだけ）
+POST_POOL_TTL = timedelta(minutes=90)           # 作り置きの賞味期限（古いネタは捨てる）
+PREGENERATE_LEAD_TIME = timedelta(minutes=30)   # 浮上の窓が開く何分前から作り始めるか
+
+
+class PostPool:
+    """定期ツイートの作り置き。種類ごとに小さいdequeで、期限切れは取り出すときに捨てる"""
+
+    def __init__(self, size=POST_POOL_SIZE, ttl=POST_POOL_TTL):
+        self.ttl = ttl
+        self.pools = {kind: deque(maxlen=size) for kind in SCHEDULED_POST_PROMPTS}
+
+    def _drop_expired(self, kind, now):
+        pool = self.pools[kind]
+        fresh = [(text, expire_time) for text, expire_time in pool if expire_time > now]
+        if len(fresh) != len(pool):
+            pool.clear()
+            pool.extend(fresh)
+
+    def missing(self, kind, now):
+        self._drop_expired(kind, now)
+        pool = self.pools[kind]
+        return pool.maxlen - len(pool)
+
+    def add(self, kind, text, now):
+        self.pools[kind].append((text, now + self.ttl))
+
+    def take(self, kind, now):
+        """一番古い候補を取り出す（残りは次に使う。期限が切れたら捨てる）。無ければ None"""
+        self._drop_expired(kind, now)
+        pool = self.pools[kind]
+        if not pool:
+            return None
+        text, _ = pool.popleft()
+        return text
+
+
+
+def kinds_to_pregenerate(state, now):
+    """もうすぐ浮上する窓で使いそうな定期ツイートの種類"""
+    soon = now + PREGENERATE_LEAD_TIME
+    if now.hour not in get_target_hours(now, state.schedule) and soon.hour not in get_target_hours(soon, state.schedule):
+        return [] # しばらく浮上しないなら作らない（期限切れで捨てるだけになる）
+
+    kinds = []
+    if state.is_first_check_of_day:
+        kinds.append("C1")
+    elif not state.did_daily_tweet:
+        kinds.append("D")
+    if now.hour == 23 or soon.hour == 23:
+        kinds.append("C2")
+    return kinds
+
+
+async def pregenerate_posts(state):
+    """浮上の窓が開く前（PREGENERATE_LEAD_TIME前）にスケジューラから呼ばれる"""
+    now = clock.now()
+    for kind in kinds_to_pregenerate(state, now):
+        for _ in range(state.post_pool.missing(kind, now)):
+            try:
+                with span("pregenerate"):
+                    response = await generate(kind, SCHEDULED_POST_PROMPTS[kind])
+                state.post_pool.add(kind, response.text, clock.now())
+                logger.info(f"[事前生成] {kind} の候補を作り置きしました。")
+            except Exception as e:
+                logger.warning(f"！！！警告： {kind} の事前生成に失敗しました（浮上時にその場で作ります）: {e}")
+                break
+
+
+async def get_scheduled_post(state, kind, now):
+    """作り置きがあればそれ、無い（or 期限切れ）ならその場でGeminiに作らせる"""
+    text = state.post_pool.take(kind, now)
+    if text is not None:
+        logger.info(f"[事前生成] {kind} の作り置きを使います。")
+        return text
+    return await generate_text(kind, SCHEDULED_POST_PROMPTS[kind])
+
+
+async def send_scheduled_post(state, channel, kind, now):
+    with span(kind):
+        await send_after_typing(channel, get_scheduled_post(state, kind, now))
+
+
+# ----------------------------------------
+# ★★★ チャンネルごとの状態（何百チャンネルでも軽いように __slots__ で） ★★★
+# ----------------------------------------
+HANDLED_MESSAGES_SIZE = 500 # 1チャンネルあたり「もう判断した」メッセージIDを何件まで覚えておくか
+
+
+class HandledMessages:
+    """返事した（かスルーと決めた）メッセージIDの上限つきLRU。ロジックA/Bで同じメッセージに2回返事しないため"""
+    __slots__ = ('size', 'ids')
+
+    def __init__(self, size=HANDLED_MESSAGES_SIZE):
+        self.size = size
+        self.ids = OrderedDict()
+
+    def __contains__(self, message_id):
+        if message_id not in self.ids:
+            return False
+        self.ids.move_to_end(message_id)
+        return True
+
+    def add(self, message_id):
+        self.ids[message_id] = None
+        self.ids.move_to_end(message_id)
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False) # 一番長く見てないのから捨てる
+
+class ChannelState:
+    """1チャンネルぶんの浮上の状態。グローバル変数だったものを全部ここに持つ"""
+    __slots__ = (
+        'channel_id', 'schedule',
+        'last_checked_time',        # 最後に「浮上」した時間
+        'last_mention_check_time',  # 最後に「メンション」をチェックした時間
+        'is_first_check_of_day', 'did_daily_tweet',
+        'pending_mentions',         # 古い順に並ぶ（あふれたら一番古いのから捨てる）
+        'mention_gap_start',        # 穴の始まり（切断・再起動・穴埋めの失敗。次の浮上でここからREST履歴で埋める）
+        'disconnected_at',          # 最後に切断された時間（RESUMEで消していい穴かどうかの目印）
+        'ego_watermark',            # ロジックBが最後に見たメッセージID（これより新しいのだけ考える）
+        'handled_messages',         # 返事した（かスルーと決めた）メッセージID
+        'verdict_failures',         # message_id（まとめ処理は ("batch", 一番古いID)）-> 判定が読めなかった回数
+        'post_pool', 'scheduler_task',
+    )
+
+    def __init__(self, channel_id, schedule=WAKE_SCHEDULE):
+        self.channel_id = channel_id
+        self.schedule = schedule
+        self.last_checked_time = None
+        self.last_mention_check_time = None
+        self.is_first_check_of_day = True
+        self.did_daily_tweet = False
+        self.pending_mentions = deque(maxlen=MAX_PENDING_MENTIONS)
+        self.mention_gap_start = None
+        self.disconnected_at = None
+        self.ego_watermark = None
+        self.handled_messages = HandledMessages()
+        self.verdict_failures = {}
+        self.post_pool = PostPool()
+        self.scheduler_task = None # 浮上スケジューラ（on_ready で1回だけ起動）
+
+
+def load_channel_states():
+    """設定（TARGET_CHANNEL_IDS と CHANNEL_SCHEDULES）からチャンネルの状態を作る"""
+    for channel_id in settings.target_channel_ids:
+        if channel_id not in channel_states:
+            schedule = {**WAKE_SCHEDULE, **settings.channel_schedules.get(str(channel_id), {})}
+            channel_states[channel_id] = ChannelState(channel_id, schedule)
+
+
+class WakeWorkerPool:
+    """浮上処理を決まった数のワーカーで回す。遅いチャンネル（Geminiが遅い、履歴が長い）が他を待たせない"""
+
+    def __init__(self, concurrency=Settings.wake_concurrency):
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue()
+        self.workers = []
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def submit(self, func, *args):
+        """func(*args) をワーカーに回して、終わるまで待つ"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            func, args, future = await self.queue.get()
+            try:
+                future.set_result(await func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+
+wake_pool = WakeWorkerPool()
+
+
+class PresenceTracker:
+    """オンライン表示はBot全体で1個なので、どこかのチャンネルで浮上中ならオンラインのままにする"""
+
+    def __init__(self):
+        self.online_count = 0
+
+    async def go_online(self):
+        self.online_count += 1
+        if self.online_count == 1:
+            with span("change_presence"):
+                await bot.change_presence(status=discord.Status.online)
+
+    async def go_offline(self):
+        self.online_count = max(self.online_count - 1, 0)
+        if self.online_count == 0:
+            with span("change_presence"):
+                await bot.change_presence(status=discord.Status.invisible)
+
+
+presence = PresenceTracker()
+
+
+# ----------------------------------------
+# ★★★ 状態の保存（SQLite / WAL）。再起動してもメンションの続きから拾える！ ★★★
+# ----------------------------------------
+STATE_FLUSH_DELAY = 5                      # 変更をまとめて書き込むまでの秒数
+BACKFILL_MAX_AGE = timedelta(hours=24)     # 起動時の穴埋めはここまでしか遡らない
+BACKFILL_LIMIT = 500                       # 起動時の穴埋めで見る履歴の最大件数
+ANSWERED_RETENTION = timedelta(days=7)     # 処理済みメッセージIDを覚えておく期間
+
+
+class StateStore:
+    """チャンネルごとの透かし（watermark）・日付フラグ・処理済みメッセージID・初回起動フラグをSQLiteに持つ。
+    書き込みは save() で印をつけておいて、flush() でまとめて1トランザクションで書く"""
+
+    def __init__(self, path=Settings.state_db_path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS channel_state (
+                channel_id INTEGER PRIMARY KEY,
+                last_checked_time TEXT,
+                last_mention_check_time TEXT,
+                is_first_check_of_day INTEGER NOT NULL DEFAULT 1,
+                did_daily_tweet INTEGER NOT NULL DEFAULT 0,
+                greeted INTEGER NOT NULL DEFAULT 0,
+                ego_watermark INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS answered_message (
+                channel_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                answered_at TEXT NOT NULL,
+                PRIMARY KEY (channel_id, message_id)
+            ) WITHOUT ROWID;
+        """)
+        # 前のバージョンで作ったDBには無い列を足す
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(channel_state)")}
+        if "ego_watermark" not in columns:
+            self.db.execute("ALTER TABLE channel_state ADD COLUMN ego_watermark INTEGER")
+        self.db.commit()
+        self.dirty_states = {}     # channel_id -> ChannelState（まだ書いてない変更）
+        self.pending_answered = {} # (channel_id, message_id) -> 処理した時間
+        self.dirty = asyncio.Event()
+        self.flusher_task = None
+
+    # --- 読み込み ---
+    def load(self, state):
+        """保存されてた状態を state に戻す。保存が無ければ False"""
+        row = self.db.execute(
+            "SELECT last_checked_time, last_mention_check_time, is_first_check_of_day, did_daily_tweet, ego_watermark"
+            " FROM channel_state WHERE channel_id = ?", (state.channel_id,)).fetchone()
+        if row is None:
+            return False
+        last_checked_time, last_mention_check_time, is_first_check_of_day, did_daily_tweet, ego_watermark = row
+        state.last_checked_time = parse_stored_time(last_checked_time)
+        state.last_mention_check_time = parse_stored_time(last_mention_check_time)
+        state.is_first_check_of_day = bool(is_first_check_of_day)
+        state.did_daily_tweet = bool(did_daily_tweet)
+        state.ego_watermark = ego_watermark
+        return True
+
+    def is_greeted(self, channel_id):
+        row = self.db.execute("SELECT greeted FROM channel_state WHERE channel_id = ?", (channel_id,)).fetchone()
+        return bool(row and row[0])
+
+    def was_answered(self, channel_id, message_id):
+        if (channel_id, message_id) in self.pending_answered:
+            return True
+        row = self.db.execute(
+            "SELECT 1 FROM answered_message WHERE channel_id = ? AND message_id = ?", (channel_id, message_id)).fetchone()
+        return row is not None
+
+    # --- 書き込み（まとめて） ---
+    def save(self, state):
+        self.dirty_states[state.channel_id] = state
+        self.dirty.set()
+
+    def record_answered(self, channel_id, message_id):
+        self.pending_answered[(channel_id, message_id)] = clock.now().isoformat()
+        self.dirty.set()
+
+    def mark_greeted(self, state):
+        """初回起動の挨拶は2回送りたくないので、すぐ書く"""
+        self.save(state)
+        self.flush()
+        self.db.execute("UPDATE channel_state SET greeted = 1 WHERE channel_id = ?", (state.channel_id,))
+        self.db.commit()
+
+    def flush(self):
+        if not self.dirty_states and not self.pending_answered:
+            return
+        rows = [
+            (
+                state.channel_id,
+                format_stored_time(state.last_checked_time),
+                format_stored_time(state.last_mention_check_time),
+                int(state.is_first_check_of_day),
+                int(state.did_daily_tweet),
+                state.ego_watermark,
+            )
+            for state in self.dirty_states.values()
+        ]
+        answered = [(channel_id, message_id, answered_at) for (channel_id, message_id), answered_at in self.pending_answered.items()]
+        with self.db:
+            self.db.executemany("""
+                INSERT INTO channel_state (channel_id, last_checked_time, last_mention_check_time, is_first_check_of_day, did_daily_tweet, ego_watermark)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(channel_id) DO UPDATE SET
+                    last_checked_time = excluded.last_checked_time,
+                    last_mention_check_time = excluded.last_mention_check_time,
+                    is_first_check_of_day = excluded.is_first_check_of_day,
+                    did_daily_tweet = excluded.did_daily_tweet,
+                    ego_watermark = excluded.ego_watermark
+            """, rows)
+            self.db.executemany("INSERT OR IGNORE INTO answered_message VALUES (?, ?, ?)", answered)
+            # 古い処理済みIDは捨てる（透かしより前のメッセージはもう拾わないので）
+            self.db.execute("DELETE FROM answered_message WHERE answered_at < ?", ((clock.now() - ANSWERED_RETENTION).isoformat(),))
+        self.dirty_states.clear()
+        self.pending_answered.clear()
+
+    async def run_flusher(self):
+        """変更があったら STATE_FLUSH_DELAY 秒ぶん貯めてからまとめて書く（何も無いときは寝てる）"""
+        while True:
+            await self.dirty.wait()
+            await asyncio.sleep(STATE_FLUSH_DELAY)
+            self.dirty.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"！！！エラー： 状態の保存に失敗しました（次の変更でもう一回やります）: {e}")
+
+    def start(self):
+        if self.flusher_task is None:
+            self.flusher_task = asyncio.create_task(self.run_flusher())
+
+
+def format_stored_time(value):
+    return value.isoformat() if value else None
+
+
+def parse_stored_time(value):
+    return datetime.fromisoformat(value).astimezone(JST) if value else None
+
+
+state_store = None # on_ready で開く
+
+
+def mark_handled(state, message_id):
+    """返事した（かスルーと決めた）メッセージを覚えておく。メモリのLRUとDBの両方に"""
+    state.handled_messages.add(message_id)
+    state_store.record_answered(state.channel_id, message_id)
+
+
+def restore_channel_state(state, now):
+    """保存されてる状態から再開する。メンションは止まってた間のぶんを1回だけ（上限つきで）穴埋めする"""
+    if state_store.load(state) and state.last_mention_check_time:
+        # 止まってた間は on_message で拾えてないので、次の浮上で履歴から穴埋めする（遡りすぎない）
+        state.last_mention_check_time = max(state.last_mention_check_time, now - BACKFILL_MAX_AGE)
+        state.mention_gap_start = state.last_mention_check_time
+        logger.info(f"#{state.channel_id} の状態を復元しました（メンションは {state.last_mention_check_time.strftime('%m/%d %H:%M:%S')} の続きから）。")
+        return
+    state.last_checked_time = now - timedelta(days=1) # 「浮上」時間は昨日（日付リセットのため）
+    state.last_mention_check_time = now # 「メンション」は今（これ以降のメンションを拾う）
+    state_store.save(state)
+
+
+# ----------------------------------------
+# ★★★ 日付リセット（毎日0時にスケジューラの追加ジョブで動く） ★★★
+# ----------------------------------------
+def reset_daily_flags_if_needed(state, now):
+    token_usage.roll_over(now) # 昨日のトークン使用量を出してからリセット
+    if state.last_checked_time and state.last_checked_time.date() != now.date():
+        logger.info(f"--- {now.strftime('%Y-%m-%d')} --- (#{state.channel_id})")
+        logger.info("日付が変わりました！フラグをリセットします。")
+        state.is_first_check_of_day = True
+        state.did_daily_tweet = False
+        state.last_checked_time = None 
+        state_store.save(state)
+
+
+def schedule_daily_reset(state, scheduler):
+    """次の0時に日付リセットを予約する（リセットが終わったら、また次の0時を予約）"""
+    now = clock.now()
+    next_midnight = JST.localize(datetime.combine(now.date() + timedelta(days=1), time(0)))
+
+    async def daily_reset():
+        reset_daily_flags_if_needed(state, clock.now())
+        schedule_daily_reset(state, scheduler)
+
+    scheduler.add_job(next_midnight, "日付リセット", daily_reset)
+
+
+# ----------------------------------------
+# ★★★ ロジックA / ロジックB（浮上するたびに毎回やる） ★★★
+# ----------------------------------------
+MAX_VERDICT_FAILURES = 3 # 判定が読めなかったとき、同じメッセージで何回までやり直すか
+
+
+def give_up_on_verdict(state, message_id, logic, error, fallback="スルー扱いにします"):
+    """判定（decision）が読めなかった回数を数える。MAX_VERDICT_FAILURES 回目なら True（あきらめて fallback する）"""
+    failures = state.verdict_failures.get(message_id, 0) + 1
+    if failures >= MAX_VERDICT_FAILURES:
+        state.verdict_failures.pop(message_id, None)
+        logger.error(f"！！！エラー： [ロジック{logic}] {failures}回続けて判定が読めなかったので、{fallback}: {error}")
+        return True
+    state.verdict_failures[message_id] = failures
+    logger.error(f"！！！エラー： [ロジック{logic}] 判定が読めませんでした（{failures}回目）。次の浮上でやり直します: {error}")
+    return False
+
+
+def advance_mention_watermark(state, when):
+    """メンションの透かしを進める。穴埋めがまだ済んでないときは、穴の始まりより先には進めない
+    （再起動しても、透かし＝穴の始まりから拾い直せるように）"""
+    if state.mention_gap_start is not None:
+        when = min(when, state.mention_gap_start)
+    state.last_mention_check_time = when
+
+
+async def handle_single_mention(state, channel, oldest_mention):
+    """メンションを1件だけ判断して、返事する（判定が読めなかったら待ち行列に残して、次の浮上でやり直す）"""
+    logger.info(f"[ロジックA] メンション発見！ (from {oldest_mention.author.display_name})")
+
+    if quick_skip.should_skip("A", [oldest_mention.content]):
+        logger.info("[ロジックA] 見ればわかるスルーなので、Geminiに聞かずにスルーします。")
+        token_usage.record_avoided("A")
+        metrics.inc("haru_logic_decisions_total", logic="A", decision="skip")
+        forget_pending_mentions(state, {oldest_mention.id})
+        mark_handled(state, oldest_mention.id)
+        advance_mention_watermark(state, oldest_mention.created_at.astimezone(JST))
+        return
+    
+    context_log = build_mention_context(channel, oldest_mention)
+    
+    # ★★★ プロンプト修正！ ★★★
+    prompt = f"""【ミッション】
+以下の会話ログで、君（ハル）宛てのメンションが来ました。
+君の役割設定（特に「BOT疑惑への対応ルール」）に従って、以下の優先順位で返事を生成してください。
+
+1.  **[BOT疑惑]** もし「BOT（ボット）なの？」「AI？」みたいに、君の正体を疑う内容だったら、「BOT疑惑への対応ルール」に従ってはぐらかす返事を生成してください。
+2.  **[返事する]** もし（1）じゃなくて、返事すべき内容（質問、会話の続き）なら、可愛げのある返事を生成してください。
+3.  **[スルー]** もし（1）でも（2）でもなく、スルーすべき内容（「おつー」「おやすみ」等の挨拶、ただの相槌、独り言）なら、スルーしてください。
+
+{VERDICT_FORMAT}
+
+【会話ログ】
+{context_log}
+"""
+    typing_delay = start_typing_delay() # 待ち時間は生成と並行で数える
+    try:
+        reply = await generate_verdict("A", prompt)
+    except ValueError as e:
+        typing_delay.cancel()
+        if not give_up_on_verdict(state, oldest_mention.id, "A", e):
+            return # 待ち行列に残して、次の浮上でやり直す（残りのロジックは続ける）
+        reply = None # 何回聞いても読めないので、スルー扱い
+    state.verdict_failures.pop(oldest_mention.id, None)
+    
+    if reply is not None:
+        logger.info("[ロジックA] Geminiが「返事すべき」と判断。返信します。")
+        metrics.inc("haru_logic_decisions_total", logic="A", decision="reply")
+        await send_after_typing(channel, reply, typing_delay)
+    else:
+        typing_delay.cancel()
+        metrics.inc("haru_logic_decisions_total", logic="A", decision="skip")
+        
+    # 返事までうまくいったら待ち行列から外す（途中で失敗したら次の浮上でやり直し）
+    forget_pending_mentions(state, {oldest_mention.id})
+    mark_handled(state, oldest_mention.id)
+    advance_mention_watermark(state, oldest_mention.created_at.astimezone(JST))
+
+
+async def run_logic_a(state, channel, now):
+    """(ロジックA) 溜まってるメンションに返事する"""
+    # 途中で失敗した浮上で、もう返事を送ったぶんは外す
+    forget_pending_mentions(state, {m.id for m in state.pending_mentions if state_store.was_answered(state.channel_id, m.id)})
+    mentions_found = list(state.pending_mentions)
+
+    # バッチモード：溜まってるメンションを全部まとめて1回で処理する
+    # （まとめ処理をあきらめて1件ずつに回したメンションは、片付くまで1件ずつのまま）
+    if mentions_found and settings.mention_batch_mode and mentions_found[0].id not in state.verdict_failures:
+        logger.info(f"[ロジックA] メンション {len(mentions_found)} 件をまとめて処理します。")
+        if await handle_mentions_batched(state, channel, mentions_found):
+            # 処理中に来たぶんは残す
+            forget_pending_mentions(state, {mention.id for mention in mentions_found})
+            advance_mention_watermark(state, mentions_found[-1].created_at.astimezone(JST))
+
+    # メンションが見つかったら、1件だけ処理する（一番古いメンション。残りは次の浮上で）
+    elif mentions_found:
+        await handle_single_mention(state, channel, mentions_found[0])
+
+    else:
+        logger.info("[ロジックA] 新しいメンションはありませんでした。")
+        advance_mention_watermark(state, now)
+
+
+async def run_logic_b(state, channel):
+    """(ロジックB) エゴサ：直近10件に自分の発言があれば、その後の流れに返事するか考える"""
+    logger.info("[ロジックB] エゴサ確認（10件）します...")
+    my_last_message_found = False
+    context_log_for_ego = ""
+    replies_to_me = [] # 自分の最後の発言より後の、まだ誰も判断してないメッセージ（返事するか考える対象）
+    pending_mention_ids = {mention.id for mention in state.pending_mentions} # メンションはロジックAの担当
+    # 直近10件をキャッシュから取る
+    recent_messages = message_cache.recent(channel.id, limit=10)
+    for message in recent_messages:
+        # ログにはbotの名前（ハル）を含める
+        author_name = "ハル" if message.author_id == bot.user.id else message.author_name
+        context_log_for_ego += f"{author_name}: {message.content}\n"
+        if message.author_id == bot.user.id:
+            my_last_message_found = True # 10件以内に自分の発言があった！
+            replies_to_me = []
+        elif (my_last_message_found
+              and (state.ego_watermark is None or message.message_id > state.ego_watermark) # 前の浮上で見たぶんは飛ばす
+              and message.message_id not in state.handled_messages
+              and message.message_id not in pending_mention_ids):
+            replies_to_me.append(message)
+
+    if not my_last_message_found:
+        logger.info("[ロジックB] 10件以内に自分の発言はありませんでした。")
+        metrics.inc("haru_logic_decisions_total", logic="B", decision="no_candidates")
+
+    # 自分の発言の後に新しいメッセージが無いなら、Geminiに聞くことがない（静かなチャンネルはほぼこれ）
+    elif not replies_to_me:
+        logger.info("[ロジックB] 自分の発言の後に、新しいメッセージはありませんでした。")
+        metrics.inc("haru_logic_decisions_total", logic="B", decision="no_new_messages")
+
+    # 自分の発言の後が挨拶・相槌だけなら、Geminiに聞くまでもない
+    elif quick_skip.should_skip("B", [message.content for message in replies_to_me]):
+        logger.info("[ロジックB] 自分の発言の後は見ればわかるスルーだけなので、Geminiに聞かずにスルーします。")
+        token_usage.record_avoided("B")
+        metrics.inc("haru_logic_decisions_total", logic="B", decision="skip")
+
+    # 新しいメッセージがあった場合のみ、Geminiに聞く
+    else:
+        logger.info("[ロジックB] 10件以内に自分の発言を発見。Geminiに精査させます。")
+        
+        # ★★★ プロンプト修正！ ★★★
+        prompt = f"""【ミッション】
+以下の直近10件の会話ログで、君（ハル）の発言（「ハル: ...」）がありました。
+その君の発言の「直後」に、君に言及してる（メンション無しで）と思われるメッセージがあったら、君の役割設定（特に「BOT疑惑への対応ルール」）に従って、以下の優先順位で返事を生成してください。
+
+1.  **[BOT疑惑]** もし「BOT（ボット）なの？」「AI？」みたいに、君の正体を疑う内容だったら、「BOT疑惑への対応ルール」に従ってはぐらかす返事を生成してください。
+2.  **[返事する]** もし（1)じゃなくて、返事すべき内容なら、可愛げのある返事を生成してください。
+3.  **[スルー]** もし（1）でも（2）でもなければ、スルーしてください。
+
+{VERDICT_FORMAT}
+
+【会話ログ】
+{context_log_for_ego}
+"""
+        typing_delay = start_typing_delay()
+        try:
+            reply = await generate_verdict("B", prompt)
+        except ValueError as e:
+            typing_delay.cancel()
+            if not give_up_on_verdict(state, replies_to_me[-1].message_id, "B", e):
+                return # 透かしは動かさずに、次の浮上でやり直す
+            reply = None # 何回聞いても読めないので、スルー扱い
+        state.verdict_failures.pop(replies_to_me[-1].message_id, None)
+        
+        if reply is not None:
+            logger.info("[ロジックB] Geminiが「返事すべき」と判断。返信します。")
+            metrics.inc("haru_logic_decisions_total", logic="B", decision="reply")
+            await send_after_typing(channel, reply, typing_delay)
+        else:
+            typing_delay.cancel()
+            logger.info("[ロジックB] Geminiが「スルーすべき」と判断しました。")
+            metrics.inc("haru_logic_decisions_total", logic="B", decision="skip")
+
+    # ここまで来たら（途中で失敗してなければ）、見たぶんは次の浮上では考えない
+    for message in replies_to_me:
+        mark_handled(state, message.message_id)
+    if recent_messages:
+        state.ego_watermark = max(state.ego_watermark or 0, recent_messages[-1].message_id)
+
+
+# ----------------------------------------
+# ★★★ 神ロジックの「核」！★★★
+# (浮上スケジュールの時間になったら、スケジューラがこの関数を呼ぶ)
+# ----------------------------------------
+async def check_activity(state, slot, catch_up=False):
+    token = log_channel_id.set(state.channel_id) # この浮上のログには全部チャンネルIDが付く
+    try:
+        with span("wake"):
+            await run_wake(state, slot, catch_up)
+    finally:
+        log_channel_id.reset(token)
+        write_metrics_textfile()
+
+
+async def run_wake(state, slot, catch_up):
+    try:
+        # --- 日付リセット処理（0時のジョブが走る前に浮上したときの保険） ---
+        reset_daily_flags_if_needed(state, clock.now())
+
+        # --- よっしゃ！浮上するぜ！ ---
+        now = clock.now()
+        
+        logger.info(f"--- ( {now.strftime('%Y-%m-%d %H:%M:%S')} ) --- (#{state.channel_id})")
+        if catch_up:
+            logger.info(f"★★★ {slot.strftime('%H:%M')} の浮上を逃したので、今から取り返します！ ★★★")
+        else:
+            logger.info(f"★★★ 浮上タイミング！ チェック開始！ ★★★")
+        
+        await presence.go_online()
+        
+        # --- チャンネルが見えるかチェック（最重要） ---
+        channel = bot.get_channel(state.channel_id) 
+        if not channel:
+            logger.error(f"！！！エラー： チャンネルID ({state.channel_id}) が見つかりません。")
+            await presence.go_offline() # オフラインに戻る
+            state.last_checked_time = now # チェック時間は記録
+            state_store.save(state)
+            return
+
+        # ----------------------------------
+        # ★★★ ここからロジック！ ★★★
+        # (1回の浮上で、該当する処理を順番に「全部」やる！)
+        # ----------------------------------
+
+        # (ロジックC1) 「塾おわ」ツイート (初回浮上時のみ、最優先)
+        # ----------------------------------
+        c1_task = None
+        if state.is_first_check_of_day:
+            logger.info("[ロジックC1] 今日初の浮上！「塾おわ」をツイートします。")
+            # 事前生成があればそれを使う。生成＆「入力中…」の間に、下の履歴の穴埋めを並行でやっておく
+            c1_task = asyncio.create_task(send_scheduled_post(state, channel, "C1", now))
+        
+        # (ロジックA) メンション確認 (毎回やる)
+        # ----------------------------------
+        logger.info("[ロジックA] メンション確認します...")
+        
+        # 切断してた間のメンションは on_message で拾えてないので、そこだけ履歴で穴埋め
+        if state.mention_gap_start is not None:
+            await backfill_pending_mentions(state, channel, now)
+
+        # 「塾おわ」が先に出てから返信する（順番は守る）
+        if c1_task:
+            await c1_task
+            state.is_first_check_of_day = False  # 「初回」フラグをOFF
+            state.did_daily_tweet = True       # 「日常」フラグもON
+
+        with span("A"):
+            await run_logic_a(state, channel, now)
+        
+        # (ロジックB) エゴサ確認（10件チェック） (毎回やる)
+        # ----------------------------------
+        with span("B"):
+            await run_logic_b(state, channel)
+
+
+        # (ロジックC2) 「寝る」ツイート (23時台のみ、最後にやる)
+        # ----------------------------------
+        if now.hour == 23: 
+            logger.info("[ロジックC2] 23時だ！寝るツイートします。")
+            
+            await send_scheduled_post(state, channel, "C2", now)
+        
+        # (ロジックD) 「日常」ツイート (「塾おわ」してない浮上時のみ)
+        # ----------------------------------
+        elif not state.is_first_check_of_day and not state.did_daily_tweet: 
+            logger.info("[ロジックD] 日常ツイートします。")
+
+            await send_scheduled_post(state, channel, "D", now)
+            state.did_daily_tweet = True
+
+        # --- チェック完了！ ---
+        logger.info("★★★ チェック完了！ オフラインに戻ります。★★★")
+        
+        await presence.go_offline()
+        state.last_checked_time = now # 「浮上チェック」の時間は最後に更新
+        state_store.save(state)
+        
+    except GeminiUnavailable as e:
+        # Geminiが使えないときは、残りの処理は飛ばして次の浮上でやり直す（メンションの透かしは動かさない！）
+        logger.warning(f"！！！警告： Geminiが使えないので、残りは次の浮上でやります (#{state.channel_id}): {e}")
+        await presence.go_offline()
+        state.last_checked_time = clock.now()
+        state_store.save(state)
+    except Exception as e:
+        logger.error(f"！！！エラー：ループ処理中に何か起きました (#{state.channel_id}): {e}")
+        await presence.go_offline()
+        state.last_checked_time = clock.now() # エラー時も時間は更新（メンションの透かしは動かさない）
+        state_store.save(state)
+
+
+# ----------------------------------------
+# ★★★ メンションの受け取り（ゲートウェイのイベントで貯める） ★★★
+# ----------------------------------------
+def is_target_channel(channel_id):
+    return channel_id in channel_states
+
+
+def is_pending_mention(message):
+    """ターゲットチャンネルで、他の人がハルにメンションしたメッセージか"""
+    if not is_target_channel(message.channel.id):
+        return False
+    if message.author == bot.user:
+        return False
+    return bot.user in message.mentions
+
+
+def push_pending_mention(state, message):
+    """待ち行列に追加する（同じメッセージは2回入れない。処理済みのも入れない）"""
+    if any(m.id == message.id for m in state.pending_mentions):
+        return
+    if state_store.was_answered(state.channel_id, message.id):
+        return
+    state.pending_mentions.append(message)
+
+
+async def backfill_pending_mentions(state, channel, now):
+    """穴（切断中・止まってた間）に来たメンションをREST履歴から拾って待ち行列に足す"""
+    # 穴埋めは必ず穴の始まりから（前の穴埋めが失敗してても、透かしが先に進んでても取りこぼさない）
+    after_time = state.mention_gap_start
+    logger.info(f"[ロジックA] メンションの穴埋め： {after_time.strftime('%H:%M:%S')} 以降の履歴を確認します...")
+    backfilled = []
+    try:
+        with span("history_backfill"):
+            async for message in channel.history(after=after_time.astimezone(pytz.UTC), before=now.astimezone(pytz.UTC), oldest_first=True, limit=BACKFILL_LIMIT):
+                backfilled.append(message)
+                if is_pending_mention(message):
+                    push_pending_mention(state, message)
+    except Exception as e:
+        logger.error(f"！！！エラー： メンション履歴の取得に失敗しました: {e}")
+        return # 次の浮上でもう一回やる
+    message_cache.merge(channel.id, backfilled) # キャッシュの穴も一緒に埋める
+
+    # 履歴から拾ったぶんと on_message で拾ったぶんを古い順に並べ直す
+    merged = sorted(state.pending_mentions, key=lambda m: m.created_at)
+    state.pending_mentions.clear()
+    state.pending_mentions.extend(merged)
+
+    if len(backfilled) >= BACKFILL_LIMIT:
+        # 上限まで取れちゃった＝まだ続きがあるかも。最後に取ったところから、次の浮上でまた穴埋めする
+        # （after は「その時刻より後」なので、同じミリ秒のメッセージを落とさないように少しだけ戻す。重なったぶんは重複チェックで消える）
+        state.mention_gap_start = backfilled[-1].created_at.astimezone(JST) - timedelta(milliseconds=1)
+        logger.warning(f"！！！警告： 穴埋めの履歴が上限（{BACKFILL_LIMIT}件）に達しました。{state.mention_gap_start.strftime('%m/%d %H:%M:%S')} 以降は次の浮上で続きを取ります (#{state.channel_id})")
+        metrics.inc("haru_backfill_truncated_total")
+        return
+    state.mention_gap_start = None
+
+
+@bot.event
+async def on_message(message):
+    if is_target_channel(message.channel.id):
+        message_cache.add(message)
+    if is_pending_mention(message):
+        push_pending_mention(channel_states[message.channel.id], message)
+
+
+@bot.event
+async def on_raw_message_edit(payload):
+    # discord.py 側のキャッシュに無い古いメッセージでも届くように raw イベントを使う
+    if is_target_channel(payload.channel_id) and 'content' in payload.data:
+        message_cache.edit(payload.channel_id, payload.message_id, payload.data['content'])
+
+
+def forget_messages(channel_id, message_ids):
+    """消されたメッセージはキャッシュからも待ち行列からも消す"""
+    message_cache.delete(channel_id, message_ids)
+    forget_pending_mentions(channel_states[channel_id], message_ids)
+
+
+def forget_pending_mentions(state, message_ids):
+    """待ち行列から外す（順番はそのまま）"""
+    if not message_ids:
+        return
+    remaining = [m for m in state.pending_mentions if m.id not in message_ids]
+    if len(remaining) != len(state.pending_mentions):
+        state.pending_mentions.clear()
+        state.pending_mentions.extend(remaining)
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    if is_target_channel(payload.channel_id):
+        forget_messages(payload.channel_id, {payload.message_id})
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if is_target_channel(payload.channel_id):
+        forget_messages(payload.channel_id, payload.message_ids)
+
+
+@bot.event
+async def on_disconnect():
+    # 切断中のイベントは届かないので、穴の始まりを覚えておく（もう穴があるなら、古いほうの始まりのまま）
+    now = clock.now()
+    for state in channel_states.values():
+        state.disconnected_at = now
+        if state.mention_gap_start is None:
+            state.mention_gap_start = now
+
+
+@bot.event
+async def on_resumed():
+    # セッション再開（RESUME）なら、切断中のイベントはDiscordが再送してくれる
+    # ただし消していいのは、この切断で開いた穴だけ（再起動の穴・穴埋めに失敗した穴は、次の浮上で埋める）
+    for state in channel_states.values():
+        if state.disconnected_at is not None and state.mention_gap_start == state.disconnected_at:
+            state.mention_gap_start = None
+        state.disconnected_at = None
+
+
+def on_scheduler_done(state, task):
+    """浮上スケジューラが止まったら（普通は止まらない）ログに出して、次の on_ready で立ち上げ直せるようにする"""
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.error(f"！！！エラー： #{state.channel_id} の浮上スケジューラが止まりました: {error!r}", exc_info=error)
+        metrics.inc("haru_scheduler_failures_total")
+    if state.scheduler_task is task:
+        state.scheduler_task = None
+
+
+async def greet_channel(state, legacy_first_boot):
+    """初回起動メッセージ（チャンネルごとにDBで覚えておく）"""
+    if state_store.is_greeted(state.channel_id):
+        return
+    if legacy_first_boot and str(state.channel_id) == settings.target_channel_id:
+        logger.info(f"「{FIRST_BOOT_FLAG_FILE}」が存在するため、#{state.channel_id} は挨拶済みとしてDBに記録します。")
+        state_store.mark_greeted(state)
+        return
+
+    logger.info(f"★★★ 初回起動を検知！ (#{state.channel_id}) ★★★")
+    try:
+        channel = bot.get_channel(state.channel_id)
+        if channel:
+            
+            # ★★★ プロンプト修正！ ★★★
+            prompt = f"""【ミッション】
+君（ハル）は、今日からこのDiscordサーバーに初めて参加しました。
+『よろしく！』みたいな、初参加の挨拶を生成してください。
+"""
+            
+            await send_after_typing(channel, generate_text("初回", prompt))
+            logger.info(f"初回起動メッセージを {channel.name} に送信しました。")
+            state_store.mark_greeted(state)
+        
+        else:
+            logger.error(f"！！！エラー： 初回起動メッセージを送るチャンネルID ({state.channel_id}) が見つかりません。")
+    
+    except Exception as e:
+        logger.error(f"！！！エラー： 初回起動メッセージの送信に失敗しました: {e}")
+
+
+async def seed_channel_cache(state):
+    """メッセージキャッシュを履歴で埋める（チャンネルごとに1回だけ）"""
+    try:
+        channel = bot.get_channel(state.channel_id)
+        if channel:
+            with span("history_seed"):
+                await message_cache.seed(channel)
+    except Exception as e:
+        logger.warning(f"！！！警告： メッセージキャッシュの準備に失敗しました (#{state.channel_id}): {e}")
+
+
+async def prepare_channel(state, legacy_first_boot):
+    await greet_channel(state, legacy_first_boot)
+    await seed_channel_cache(state)
+
+
+async def prepare_channels(states):
+    """挨拶（入力中…の待ち＋Gemini）とキャッシュの準備を、浮上と同じワーカーで回す。
+    1チャンネルずつ順番に待たないので、遅いチャンネルがあっても他は先に準備できる"""
+    legacy_first_boot = os.path.exists(FIRST_BOOT_FLAG_FILE) # 昔のフラグファイルがあれば、TARGET_CHANNEL_ID は「挨拶済み」として引き継ぐ
+    await asyncio.gather(*(wake_pool.submit(prepare_channel, state, legacy_first_boot) for state in states))
+    logger.info(f"メッセージキャッシュを準備しました（{len(message_cache.seeded)}チャンネル）。")
+
+
+# ----------------------------------------
+# Botが起動したときに呼ばれる処理
+# ----------------------------------------
+@bot.event
+async def on_ready():
+    logger.info(f'--- {bot.user} (ハル) がDiscordにログインしました ---')
+    logger.info('受験期モード、起動します...')
+
+    global state_store, metrics_server, warmed_up, startup_started_at, channel_prep_task
+    if state_store is None:
+        state_store = StateStore(settings.state_db_path)
+        state_store.start()
+    if settings.metrics_port and metrics_server is None:
+        try:
+            metrics_server = await start_metrics_server()
+        except OSError as e:
+            logger.warning(f"！！！警告： メトリクスのHTTPサーバーを起動できませんでした: {e}")
+            metrics_server = False # 再接続のたびに同じ失敗を繰り返さない
+
+    # ★★★ on_ready は再接続のたびにも呼ばれるので、状態の復元はチャンネルごとに最初の1回だけ！ ★★★
+    load_channel_states()
+    for state in channel_states.values():
+        state.disconnected_at = None # 新しいセッション（IDENTIFY）なので、切断中のぶんは再送されない。穴は次の浮上で埋める
+    if not channel_states:
+        logger.warning("！！！警告： TARGET_CHANNEL_ID(S) が設定されてないため、どこにも発言できません。")
+    for state in channel_states.values():
+        if state.last_mention_check_time is None:
+            restore_channel_state(state, clock.now())
+
+    # ----------------------------------
+    # ★★★ Geminiのウォームアップ（最初の浮上より前に1回だけ） ★★★
+    # ----------------------------------
+    if settings.gemini_warmup and not warmed_up:
+        warmed_up = True
+        await warm_up_gemini()
+
+    # ----------------------------------
+    # ★★★ スケジューラ起動もチャンネルごとに最初の1回だけ！ ★★★
+    # ----------------------------------
+    wake_pool.start()
+    for state in channel_states.values():
+        if state.scheduler_task is None:
+            scheduler = WakeScheduler(
+                functools.partial(wake_pool.submit, check_activity, state),
+                schedule=state.schedule,
+                lead_jobs=[(PREGENERATE_LEAD_TIME, "事前生成", functools.partial(pregenerate_posts, state))],
+                last_woke_at=state.last_checked_time,
+            )
+            schedule_daily_reset(state, scheduler)
+            state.scheduler_task = asyncio.create_task(scheduler.run())
+            state.scheduler_task.add_done_callback(functools.partial(on_scheduler_done, state))
+    logger.info(f"{len(channel_states)}チャンネルの浮上スケジュールを開始しました（同時に最大{settings.wake_concurrency}チャンネル）。")
+
+    # ----------------------------------
+    # ★★★ 初回の挨拶とメッセージキャッシュの準備は、スケジューラを止めないように裏でやる ★★★
+    # ----------------------------------
+    if channel_prep_task is None or channel_prep_task.done():
+        channel_prep_task = asyncio.create_task(prepare_channels(list(channel_states.values())))
+
+    if presence.online_count == 0:
+        await bot.change_presence(status=discord.Status.invisible)
+
+    # 起動（main）から最初の準備完了までの時間（再接続の on_ready では測らない）
+    if startup_started_at is not None:
+        startup_seconds = time_module.monotonic() - startup_started_at
+        startup_started_at = None
+        metrics.set_gauge("haru_startup_seconds", startup_seconds)
+        logger.info(f"起動から準備完了まで {startup_seconds:.2f}秒でした。")
+
+# ----------------------------------------
+# Botを起動！
+# ----------------------------------------
+startup_started_at = None # main() が呼ばれた時間（準備完了までを測る）
+warmed_up = False
+channel_prep_task = None  # 初回の挨拶・キャッシュ準備（on_ready から裏で回す）
+
+
+def configure(new_settings):
+    """設定を入れ替えて、設定から作るもの（Gemini呼び出し口・ワーカー・一次判定）を作り直す"""
+    global settings, gemini_client, wake_pool, quick_skip
+    settings = new_settings
+    gemini_client = GeminiClient(
+        timeout=settings.gemini_timeout_seconds, max_in_flight=settings.gemini_max_in_flight,
+        rate_per_minute=settings.gemini_rate_per_minute, max_retries=settings.gemini_max_retries)
+    wake_pool = WakeWorkerPool(settings.wake_concurrency)
+    quick_skip = QuickSkipClassifier(QUICK_SKIP_PHRASES + list(settings.quick_skip_extra_phrases),
+                                     enabled=settings.quick_skip_enabled)
+
+
+def main():
+    global startup_started_at
+    startup_started_at = time_module.monotonic()
+    load_dotenv() # .env を読むのはここだけ（import しただけでは読まない）
+    try:
+        new_settings = Settings.from_env()
+    except ConfigError as e:
+        setup_logging()
+        for problem in e.problems:
+            logger.error(f"！！！エラー： {problem}")
+        return 1
+    configure(new_settings)
+    setup_logging(settings.log_level, settings.log_format)
+
+    try:
+        logger.info("「ハル」を起動します...")
+        # ★★★ トークンエラーがここで起きるなら、大文字小文字、コピペミス、権限設定が原因！ ★★★
+        bot.run(settings.discord_token)
+        if state_store:
+            state_store.flush() # 止まる前に、まだ書いてない状態を書いておく
+    except discord.errors.LoginFailure as e:
+        logger.error("！！！エラー： ログインに失敗しました (LoginFailure)。")
+        logger.error("！！！原因： Discordトークンが間違っているか、古いです。Renderの環境変数を見直して！")
+        return 1
+    except discord.errors.PrivilegedIntentsRequired as e:
+        logger.error("！！！エラー： 権限が足りません (PrivilegedIntentsRequired)。")
+        logger.error("！！！原因： Discord Developer Portal の「MESSAGE CONTENT INTENT」がONになっていません！")
+        return 1
+    except Exception as e:
+        logger.error(f"！！！エラー：Botの起動に失敗しました。: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())